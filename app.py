@@ -1,22 +1,94 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g, send_file
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 import os
+import re
+import csv
+import json
+import time
+import hmac
+import hashlib
+import threading
+import gzip
+import shutil
+import tempfile
+from types import SimpleNamespace
+from collections import OrderedDict
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_migrate import Migrate
+import click
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
 import plaid
 from plaid.api import plaid_api
+import jwt
+import numpy as np
 
 app = Flask(__name__, instance_relative_config=True)
 app.config['SECRET_KEY'] = 'your_secret_key'
 # Configurazione del database: se DATABASE_URL non è impostato, usa SQLite nella cartella instance
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(app.instance_path, 'expenses.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Archiviazione: le righe più vecchie di ARCHIVE_HORIZON_DAYS vengono spostate in file CSV compressi
+app.config['ARCHIVE_HORIZON_DAYS'] = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 730))
+app.config['ARCHIVE_FOLDER'] = os.environ.get('ARCHIVE_FOLDER', os.path.join(app.instance_path, 'archive'))
+# Le lapidi della sincronizzazione delta più vecchie di TOMBSTONE_RETENTION_DAYS vengono eliminate
+app.config['TOMBSTONE_RETENTION_DAYS'] = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 90))
+# Bytecode dei template compilati, condiviso tra i worker e tra un riavvio e l'altro
+app.config['JINJA_CACHE_FOLDER'] = os.environ.get('JINJA_CACHE_FOLDER', os.path.join(app.instance_path, 'jinja_cache'))
+app.config['NAV_FRAGMENT_CACHE'] = True
+os.makedirs(app.config['JINJA_CACHE_FOLDER'], exist_ok=True)
+app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(app.config['JINJA_CACHE_FOLDER']))
+# Ricevute: file salvati con l'hash SHA-256 del contenuto come nome. In produzione vengono
+# serviti dal proxy e non dal worker Flask: con RECEIPT_ACCEL_PREFIX=/_ricevute/ nginx deve
+# avere "location /_ricevute/ { internal; alias <RECEIPT_FOLDER>/; }"
+app.config['RECEIPT_FOLDER'] = os.environ.get('RECEIPT_FOLDER', os.path.join(app.instance_path, 'receipts'))
+app.config['RECEIPT_ACCEL_PREFIX'] = os.environ.get('RECEIPT_ACCEL_PREFIX')
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024
+# Metodo di hash delle password nel formato di werkzeug, es. "pbkdf2:sha512:600000"
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+app.config['LOGIN_THROTTLE'] = True
+# Numero di proxy fidati davanti all'applicazione (1 per il router di Heroku): request.remote_addr
+# viene preso da X-Forwarded-For, altrimenti tutti i client avrebbero l'indirizzo del proxy.
+# Con 0 (nessun proxy) l'header viene ignorato, perché il client potrebbe falsificarlo.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 1))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# SQLite applica ON DELETE CASCADE solo con il controllo delle chiavi esterne attivo
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if dbapi_connection.__class__.__module__.startswith('sqlite3'):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+# Esecuzione di lavori in background (fuori dal ciclo della richiesta), ognuno con il proprio app context
+background_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BACKGROUND_WORKERS', 2)))
+
+def run_in_background(func, *args):
+    def job():
+        with app.app_context():
+            try:
+                func(*args)
+            except Exception:
+                app.logger.exception("Errore nel lavoro in background %s", func.__name__)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+    return background_executor.submit(job)
+
 # Configurazione del client Plaid in modalità Produzione
 configuration = plaid.Configuration(
     host=plaid.Environment.Production,
@@ -30,21 +102,42 @@ api_client = plaid.ApiClient(configuration)
 plaid_client = plaid_api.PlaidApi(api_client)
 
 # Modelli del database
+class Family(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    members = db.relationship('User', backref='family', lazy=True)
+    budgets = db.relationship('Budget', backref='family', passive_deletes=True, lazy=True)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
-    family = db.Column(db.String(100))
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id', ondelete='SET NULL'), index=True)
     preferences = db.Column(db.Text)
-    expenses = db.relationship('Expense', backref='user', cascade="all, delete-orphan", lazy=True)
-    incomes = db.relationship('Income', backref='user', cascade="all, delete-orphan", lazy=True)
-    loans = db.relationship('Loan', backref='user', cascade="all, delete-orphan", lazy=True)
-    recurring_payments = db.relationship('RecurringPayment', backref='user', cascade="all, delete-orphan", lazy=True)
+    expenses = db.relationship('Expense', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    incomes = db.relationship('Income', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    loans = db.relationship('Loan', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    recurring_payments = db.relationship('RecurringPayment', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
     notifications_enabled = db.Column(db.Boolean, default=True)
     family_expense_threshold = db.Column(db.Float, default=100.0)  # Soglia in € per notifiche push relative alle spese familiari
     avatar = db.Column(db.String(200), default='avatar1.jpg')  # Salva il nome del file avatar (presente in static/avatars)
-    cards = db.relationship('Card', backref='user', cascade="all, delete-orphan", lazy=True)
+    cards = db.relationship('Card', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    category_rules = db.relationship('CategoryRule', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    reconciliations = db.relationship('Reconciliation', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    budgets = db.relationship('Budget', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    spend_counters = db.relationship('SpendCounter', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    archive_rollups = db.relationship('ArchiveRollup', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    tombstones = db.relationship('Tombstone', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    receipts = db.relationship('Receipt', backref='user', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+    base_currency = db.Column(db.String(3), default='EUR')  # valuta in cui vengono calcolati tutti i totali
+    archived_before = db.Column(db.Date)  # le righe con data precedente sono nei file di archivio
+    deleted_at = db.Column(db.DateTime)  # account eliminato, in attesa della cancellazione dei dati
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # ultimo numero della sequenza delle modifiche
+    tombstones_pruned_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # lapidi eliminate fino a questo numero
+    # Ultimi id già considerati dalla riconciliazione (per elaborare solo le righe nuove)
+    reconciled_expense_id = db.Column(db.Integer, default=0)
+    reconciled_transaction_id = db.Column(db.Integer, default=0)
 
 class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -52,7 +145,13 @@ class Expense(db.Model):
     amount = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(200))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    currency = db.Column(db.String(3), default='EUR')
+    updated_at = db.Column(db.DateTime)
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Usato dalle viste di famiglia per la spesa più recente di ogni membro
+    __table_args__ = (db.Index('ix_expense_user_id_date', 'user_id', 'date'),
+                      db.Index('ix_expense_user_id_change_seq', 'user_id', 'change_seq'))
 
 class Income(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -60,7 +159,11 @@ class Income(db.Model):
     amount = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(200))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    currency = db.Column(db.String(3), default='EUR')
+    updated_at = db.Column(db.DateTime)
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (db.Index('ix_income_user_id_change_seq', 'user_id', 'change_seq'),)
 
 class Loan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,7 +172,10 @@ class Loan(db.Model):
     amount = db.Column(db.Float, nullable=False)
     due_date = db.Column(db.Date, nullable=False)
     description = db.Column(db.String(200))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    updated_at = db.Column(db.DateTime)
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (db.Index('ix_loan_user_id_change_seq', 'user_id', 'change_seq'),)
 
 class RecurringPayment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -78,17 +184,22 @@ class RecurringPayment(db.Model):
     due_date = db.Column(db.Date, nullable=False)
     recurrence = db.Column(db.String(50))  # es: "Giornaliero", "Settimanale", "Mensile", "Annuale"
     description = db.Column(db.String(200))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    updated_at = db.Column(db.DateTime)
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (db.Index('ix_recurring_payment_user_id_change_seq', 'user_id', 'change_seq'),)
 
 # Nuovo modello per la registrazione delle carte di pagamento
 class Card(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     card_name = db.Column(db.String(100), nullable=False)
     card_network = db.Column(db.String(50))  # es. Visa, Mastercard
     masked_number = db.Column(db.String(20))  # es. "**** **** **** 1234"
     plaid_access_token = db.Column(db.String(500))
-    transactions = db.relationship('Transaction', backref='card', cascade="all, delete-orphan", lazy=True)
+    plaid_item_id = db.Column(db.String(100), index=True)  # item Plaid a cui si riferiscono i webhook
+    plaid_cursor = db.Column(db.Text)  # cursore di /transactions/sync: le sincronizzazioni ripartono da qui
+    transactions = db.relationship('Transaction', backref='card', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
 
 # Nuovo modello per le transazioni
 class Transaction(db.Model):
@@ -98,42 +209,1205 @@ class Transaction(db.Model):
     amount = db.Column(db.Float, nullable=False)
     direction = db.Column(db.String(10), nullable=False)  # 'in' per entrate, 'out' per uscite
     description = db.Column(db.String(200))
-    card_id = db.Column(db.Integer, db.ForeignKey('card.id'), nullable=False)
+    card_id = db.Column(db.Integer, db.ForeignKey('card.id', ondelete='CASCADE'), nullable=False, index=True)
+    category = db.Column(db.String(100))  # assegnata dalle regole di categorizzazione (None se nessuna regola corrisponde)
+    currency = db.Column(db.String(3), default='EUR')  # iso_currency_code fornito da Plaid
+    updated_at = db.Column(db.DateTime)
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (db.Index('ix_transaction_card_id_change_seq', 'card_id', 'change_seq'),)
+
+# Cambi di riferimento BCE: unità di 'currency' per 1 euro nella data indicata
+class ExchangeRate(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.UniqueConstraint('currency', 'date', name='uq_exchange_rate_currency_date'),)
 
-# Funzione per ottenere le notifiche di scadenza (entro 7 giorni)
-def get_due_notifications():
-    notifications = []
-    today = datetime.now().date()
-    threshold = today + timedelta(days=7)
-    # Prestiti in scadenza
-    upcoming_loans = Loan.query.filter(Loan.due_date <= threshold).all()
-    for loan in upcoming_loans:
-        notifications.append(f"Attenzione: {loan.name} ha scadenza il {loan.due_date.strftime('%d-%m-%Y')}")
-    # Pagamenti ricorrenti in scadenza
-    upcoming_recurring = RecurringPayment.query.filter(RecurringPayment.due_date <= threshold).all()
-    for payment in upcoming_recurring:
-        notifications.append(f"Attenzione: {payment.name} scade il {payment.due_date.strftime('%d-%m-%Y')}")
-    return notifications
+# Abbinamento tra una spesa inserita manualmente e la stessa operazione arrivata da Plaid
+class Reconciliation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id', ondelete='CASCADE'), nullable=False, unique=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id', ondelete='CASCADE'), nullable=False, unique=True)
+    score = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expense = db.relationship('Expense', backref=db.backref('reconciliation', uselist=False, cascade="all, delete-orphan", passive_deletes=True))
+    transaction = db.relationship('Transaction', backref=db.backref('reconciliation', uselist=False, cascade="all, delete-orphan", passive_deletes=True))
+
+# Ricevuta allegata a una spesa o a una transazione; più righe possono condividere lo stesso file
+class Receipt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    expense_id = db.Column(db.Integer, db.ForeignKey('expense.id', ondelete='CASCADE'), index=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id', ondelete='CASCADE'), index=True)
+    # Dopo l'archiviazione la riga non è più nel database: resta l'id registrato nel segmento
+    archived_expense_id = db.Column(db.Integer, index=True)
+    archived_transaction_id = db.Column(db.Integer, index=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)  # hash del file caricato
+    file_sha256 = db.Column(db.String(64), index=True)  # hash della copia servita, senza metadati
+    content_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    original_name = db.Column(db.String(200))
+    status = db.Column(db.String(10), nullable=False, default='pending')  # 'pending', 'ready' oppure 'error'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expense = db.relationship('Expense', backref=db.backref('receipts', cascade="all, delete-orphan", passive_deletes=True, lazy=True))
+    transaction = db.relationship('Transaction', backref=db.backref('receipts', cascade="all, delete-orphan", passive_deletes=True, lazy=True))
+
+# Budget mensile per categoria: personale oppure condiviso con la famiglia (se 'family_id' è valorizzato)
+class Budget(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id', ondelete='CASCADE'), index=True)
+    category = db.Column(db.String(100), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    alerts = db.relationship('BudgetAlert', backref='budget', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
+
+# Spesa progressiva per utente, categoria e mese, aggiornata a ogni scrittura
+class SpendCounter(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    category = db.Column(db.String(100), nullable=False)
+    month = db.Column(db.Date, nullable=False)  # primo giorno del mese
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'category', 'month', name='uq_spend_counter_user_category_month'),)
+
+# Superamento di un budget, generato nel momento in cui la spesa lo supera
+class BudgetAlert(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False, index=True)
+    month = db.Column(db.Date, nullable=False)
+    message = db.Column(db.String(300), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# Totali mensili delle righe archiviate, per mantenere corretti bilanci e grafici
+class ArchiveRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'expense', 'transaction_in' oppure 'transaction_out'
+    category = db.Column(db.String(100))
+    month = db.Column(db.Date, nullable=False)  # primo giorno del mese
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# Righe eliminate, conservate come "lapidi" perché i client offline possano rimuoverle
+class Tombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)  # chiave di SYNC_MODELS, es. 'expenses'
+    row_id = db.Column(db.Integer, nullable=False)
+    change_seq = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_tombstone_user_id_change_seq', 'user_id', 'change_seq'),)
+
+# Regole di categorizzazione automatica delle transazioni sincronizzate
+class CategoryRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = db.Column(db.String(10), nullable=False)  # 'contains', 'regex' oppure 'amount'
+    pattern = db.Column(db.String(200))  # testo o espressione regolare da cercare nella descrizione
+    min_amount = db.Column(db.Float)  # estremi dell'intervallo per le regole 'amount'
+    max_amount = db.Column(db.Float)
+    category = db.Column(db.String(100), nullable=False)
+
+# Sincronizzazione delta per i client offline: ogni modifica a queste tabelle riceve il
+# numero successivo della sequenza dell'utente (User.change_seq) e ogni eliminazione lascia
+# una Tombstone. Il token del client è l'ultimo numero di sequenza ricevuto.
+SYNC_MODELS = {'expenses': Expense, 'incomes': Income, 'loans': Loan,
+               'recurring_payments': RecurringPayment, 'transactions': Transaction}
+SYNC_KINDS = {model: kind for kind, model in SYNC_MODELS.items()}
+# Non sincronizzati, ma cambiano i totali mostrati all'utente (es. la dashboard):
+# una loro modifica fa comunque avanzare la sequenza
+SEQUENCE_ONLY_MODELS = (Budget, Reconciliation)
+
+def next_change_seq(user_id):
+    # L'UPDATE blocca la riga dell'utente fino al commit, quindi i numeri seguono l'ordine dei commit
+    User.query.filter_by(id=user_id).update({User.change_seq: User.change_seq + 1}, synchronize_session=False)
+    return db.session.query(User.change_seq).filter_by(id=user_id).scalar()
+
+def sync_owner(obj):
+    if isinstance(obj, Transaction):
+        if obj.card is not None:
+            return obj.card.user_id
+        return db.session.query(Card.user_id).filter_by(id=obj.card_id).scalar()
+    return obj.user_id
+
+@event.listens_for(db.session, 'before_flush')
+def track_sync_changes(session, flush_context, instances):
+    changed, deleted = {}, {}
+    for obj in session.new:
+        if type(obj) in SYNC_KINDS:
+            changed.setdefault(sync_owner(obj), []).append(obj)
+    for obj in session.dirty:
+        if type(obj) in SYNC_KINDS and session.is_modified(obj, include_collections=False):
+            changed.setdefault(sync_owner(obj), []).append(obj)
+    for obj in session.deleted:
+        if type(obj) in SYNC_KINDS:
+            deleted.setdefault(sync_owner(obj), []).append(obj)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, SEQUENCE_ONLY_MODELS) and (obj not in session.dirty or session.is_modified(obj, include_collections=False)):
+            changed.setdefault(obj.user_id, [])
+    now = datetime.utcnow()
+    for user_id in set(changed) | set(deleted):
+        seq = next_change_seq(user_id)
+        for obj in changed.get(user_id, []):
+            obj.updated_at = now
+            obj.change_seq = seq
+        for obj in deleted.get(user_id, []):
+            session.add(Tombstone(user_id=user_id, kind=SYNC_KINDS[type(obj)], row_id=obj.id, change_seq=seq, deleted_at=now))
+
+# Le istruzioni UPDATE/DELETE in blocco non passano dagli eventi della sessione:
+# chi le esegue aggiunge questi valori o registra le lapidi con un INSERT ... SELECT
+def bulk_change_values(model, user_id):
+    return {model.updated_at: datetime.utcnow(), model.change_seq: next_change_seq(user_id)}
+
+def record_tombstones(model, user_id, query):
+    rows = query.with_entities(db.literal(user_id), db.literal(SYNC_KINDS[model]), model.id,
+                               db.literal(next_change_seq(user_id)), db.literal(datetime.utcnow()))
+    db.session.execute(Tombstone.__table__.insert().from_select(
+        ['user_id', 'kind', 'row_id', 'change_seq', 'deleted_at'], rows.statement))
+
+# Elimina le lapidi più vecchie di before e ricorda fin dove sono arrivate:
+# i client con un token precedente non possono più ricevere quelle eliminazioni
+def prune_tombstones(user_id, before):
+    newest = db.session.query(db.func.max(Tombstone.change_seq))\
+                .filter(Tombstone.user_id == user_id, Tombstone.deleted_at < before).scalar()
+    if newest is None:
+        return 0
+    pruned = Tombstone.query.filter(Tombstone.user_id == user_id, Tombstone.change_seq <= newest)\
+                .delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).update({User.tombstones_pruned_seq: newest}, synchronize_session=False)
+    db.session.commit()
+    return pruned
+
+@app.cli.command('prune-tombstones')
+def prune_tombstones_command():
+    before = datetime.utcnow() - timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS'])
+    for (user_id,) in db.session.query(User.id).all():
+        pruned = prune_tombstones(user_id, before)
+        if pruned:
+            print(f"Utente {user_id}: eliminate {pruned} lapidi.")
+
+def sync_row(obj):
+    row = {}
+    for column in obj.__table__.columns:
+        value = getattr(obj, column.name)
+        row[column.name] = value.isoformat() if hasattr(value, 'isoformat') else value
+    return row
+
+# Conversione valutaria: i cambi sono letti dalla tabella ExchangeRate (con l'euro
+# come valuta pivot) e memorizzati per (valuta, data). Nei giorni senza quotazione
+# (festivi, fine settimana) si usa l'ultimo cambio disponibile.
+CURRENCIES = ['EUR', 'USD', 'GBP', 'CHF', 'JPY']
+RATE_CACHE_SIZE = 8192
+_rate_cache = OrderedDict()
+_rate_lock = threading.Lock()
+
+# Versione della tabella dei cambi, letta una volta per richiesta: la chiave della cache la
+# comprende, quindi ogni worker vede i cambi caricati da 'load-exchange-rates' senza riavvio
+def exchange_rates_version():
+    if 'exchange_rates_version' not in g:
+        g.exchange_rates_version = db.session.query(db.func.max(ExchangeRate.id)).scalar() or 0
+    return g.exchange_rates_version
+
+def get_rate(currency, date):
+    if not currency or currency == 'EUR':
+        return 1.0
+    key = (currency, date, exchange_rates_version())
+    with _rate_lock:
+        if key in _rate_cache:
+            _rate_cache.move_to_end(key)
+            return _rate_cache[key]
+    row = ExchangeRate.query.filter(ExchangeRate.currency == currency, ExchangeRate.date <= date)\
+            .order_by(ExchangeRate.date.desc()).first()
+    if row is None:
+        # Data precedente al primo cambio caricato: si usa il più vecchio disponibile
+        row = ExchangeRate.query.filter(ExchangeRate.currency == currency).order_by(ExchangeRate.date).first()
+    if row is None:
+        # Memorizzato anche il cambio mancante: caricarne uno nuovo cambia la versione nella chiave
+        app.logger.warning("Nessun cambio disponibile per %s: importi esclusi dai totali", currency)
+    rate = row.rate if row is not None else None
+    with _rate_lock:
+        _rate_cache[key] = rate
+        if len(_rate_cache) > RATE_CACHE_SIZE:
+            _rate_cache.popitem(last=False)
+    return rate
+
+def convertible(currency, date, to_currency):
+    currency = currency or 'EUR'
+    return currency == to_currency or (get_rate(currency, date) is not None and get_rate(to_currency, date) is not None)
+
+# Senza cambio l'importo vale 0, cioè resta fuori dai totali invece di esservi sommato
+# come se fosse già nella valuta base; le pagine lo segnalano (vedi inject_unconverted_currencies)
+def convert_amount(amount, currency, date, to_currency):
+    currency = currency or 'EUR'
+    if currency == to_currency or not amount:
+        return amount
+    from_rate, to_rate = get_rate(currency, date), get_rate(to_currency, date)
+    if from_rate is None or to_rate is None:
+        g.setdefault('unconverted_currencies', set()).add(currency if from_rate is None else to_currency)
+        return 0.0
+    return amount / from_rate * to_rate
+
+# Somma convertita nella valuta base. 'query' deve selezionare, dopo le eventuali chiavi
+# di raggruppamento, la valuta, la data e la somma (vedi currency_group_columns):
+# le righe già nella valuta base formano un solo gruppo, le altre un gruppo per
+# (valuta, data), quindi i cambi si cercano una volta per gruppo e non per riga.
+def currency_group_columns(model, amount, base_currency):
+    date_key = db.type_coerce(db.case((db.func.coalesce(model.currency, 'EUR') == base_currency, db.null()), else_=model.date), db.Date)
+    currency_key = db.func.coalesce(model.currency, 'EUR')
+    return [currency_key, date_key, db.func.sum(amount)], [currency_key, date_key]
+
+def converted_totals(rows, base_currency, keys=0):
+    totals = {}
+    for row in rows:
+        key = tuple(row[:keys]) if keys > 1 else (row[0] if keys == 1 else None)
+        currency, date, total = row[keys:]
+        if currency != base_currency:
+            total = convert_amount(total, currency, date, base_currency)
+        totals[key] = totals.get(key, 0) + (total or 0)
+    return totals
+
+def load_exchange_rates(path):
+    # Formato dello storico BCE (eurofxref-hist.csv): Date,USD,JPY,... con 'N/A' se mancante
+    existing = {(c, d) for c, d in db.session.query(ExchangeRate.currency, ExchangeRate.date).all()}
+    new_rates = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            date = datetime.strptime(row.pop('Date').strip(), '%Y-%m-%d').date()
+            for currency, value in row.items():
+                currency = (currency or '').strip()
+                value = (value or '').strip()
+                if not currency or not value or value == 'N/A' or (currency, date) in existing:
+                    continue
+                new_rates.append({'currency': currency, 'date': date, 'rate': float(value)})
+    db.session.bulk_insert_mappings(ExchangeRate, new_rates)
+    db.session.commit()
+    g.pop('exchange_rates_version', None)
+    if new_rates:
+        # Gli importi esclusi per mancanza di cambio entrano ora nei contatori dei budget
+        rebuild_spend_counters()
+    return len(new_rates)
+
+@app.cli.command('load-exchange-rates')
+@click.argument('path')
+def load_exchange_rates_command(path):
+    count = load_exchange_rates(path)
+    print(f"Caricati {count} cambi.")
+
+# Motore di categorizzazione: le regole dell'utente vengono compilate una sola volta
+# in un matcher riutilizzato per tutte le transazioni di una sincronizzazione.
+def normalize_description(text):
+    return re.sub(r'\s+', ' ', (text or '').strip().lower())
+
+# Le regole 'regex' sono scritte dagli utenti: lunghezza limitata e niente quantificatori
+# annidati come (a+)+, che con il backtracking richiedono tempo esponenziale (ReDoS)
+REGEX_RULE_MAX_LENGTH = 100
+
+def nested_quantifiers(pattern):
+    stack, quantified, i = [], False, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if ch == '[':
+            # Le classi di caratteri non contengono gruppi né quantificatori
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif ch == '(':
+            stack.append(quantified)
+            quantified = False
+        elif ch == ')' and stack:
+            if quantified and pattern[i + 1:i + 2] in ('+', '*', '{'):
+                return True
+            quantified = stack.pop() or quantified
+        elif ch in '+*{':
+            quantified = True
+        i += 1
+    return False
+
+def valid_regex_rule(pattern):
+    if not pattern or len(pattern) > REGEX_RULE_MAX_LENGTH or nested_quantifiers(pattern):
+        return False
+    try:
+        re.compile(pattern)
+    except re.error:
+        return False
+    return True
+
+class Categorizer:
+    def __init__(self, rules, learned):
+        # Regole 'contains': un'unica alternanza compilata, con i pattern più lunghi
+        # (più specifici) per primi, al posto di un ciclo su ogni regola
+        self.contains = {}
+        for rule in rules:
+            if rule.kind == 'contains' and rule.pattern:
+                self.contains.setdefault(normalize_description(rule.pattern), rule.category)
+        keywords = sorted(self.contains, key=len, reverse=True)
+        self.contains_re = re.compile('|'.join(re.escape(k) for k in keywords)) if keywords else None
+        self.regexes = []
+        for rule in rules:
+            # Le regole salvate prima dei controlli su lunghezza e annidamento vengono ignorate
+            if rule.kind == 'regex' and valid_regex_rule(rule.pattern):
+                self.regexes.append((re.compile(rule.pattern, re.IGNORECASE), rule.category))
+        self.amounts = [(rule.min_amount, rule.max_amount, rule.category) for rule in rules if rule.kind == 'amount']
+        # Associazioni apprese dalle spese inserite manualmente (descrizione normalizzata -> categoria),
+        # cercate come parole intere: "esselunga" riconosce "esselunga milano 123",
+        # ma "bar" non riconosce "barbiere"
+        self.learned = learned
+        learned_keys = sorted(learned, key=len, reverse=True)
+        self.learned_re = re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(k) for k in learned_keys) + r')(?!\w)') if learned_keys else None
+
+    def categorize(self, description, amount):
+        text = normalize_description(description)
+        if self.contains_re is not None:
+            match = self.contains_re.search(text)
+            if match:
+                return self.contains[match.group(0)]
+        for regex, category in self.regexes:
+            if regex.search(description or ''):
+                return category
+        if self.learned_re is not None:
+            match = self.learned_re.search(text)
+            if match:
+                return self.learned[match.group(0)]
+        value = abs(amount)
+        for min_amount, max_amount, category in self.amounts:
+            if (min_amount is None or value >= min_amount) and (max_amount is None or value <= max_amount):
+                return category
+        return None
+
+# Cache dei matcher per utente, invalidata quando cambiano le regole o le spese manuali
+_categorizer_cache = {}
+
+def get_categorizer(user_id):
+    signature = (
+        db.session.query(db.func.count(CategoryRule.id), db.func.max(CategoryRule.id))
+            .filter(CategoryRule.user_id == user_id).one(),
+        db.session.query(db.func.count(Expense.id), db.func.max(Expense.id))
+            .filter(Expense.user_id == user_id).one(),
+    )
+    cached = _categorizer_cache.get(user_id)
+    if cached and cached[0] == signature:
+        return cached[1]
+    rules = CategoryRule.query.filter_by(user_id=user_id).order_by(CategoryRule.id).all()
+    # Per ogni descrizione si usa la categoria scelta più spesso dall'utente
+    counts = db.session.query(Expense.description, Expense.category, db.func.count(Expense.id))\
+                .filter(Expense.user_id == user_id, Expense.description.isnot(None))\
+                .group_by(Expense.description, Expense.category).all()
+    learned, best = {}, {}
+    for description, category, count in counts:
+        key = normalize_description(description)
+        # Descrizioni troppo corte corrisponderebbero a quasi ogni transazione
+        if len(key) >= 3 and count > best.get(key, 0):
+            learned[key] = category
+            best[key] = count
+    categorizer = Categorizer(rules, learned)
+    _categorizer_cache[user_id] = (signature, categorizer)
+    return categorizer
+
+def invalidate_categorizer(user_id):
+    _categorizer_cache.pop(user_id, None)
+
+# Registra in blocco le transazioni ricevute da Plaid per una carta, saltando quelle già presenti
+def ingest_transactions(card, transactions_data):
+    external_ids = [t['transaction_id'] for t in transactions_data]
+    existing = set()
+    if external_ids:
+        existing = {row[0] for row in db.session.query(Transaction.external_id)
+                    .filter(Transaction.external_id.in_(external_ids)).all()}
+    categorizer = get_categorizer(card.user_id)
+    new_transactions = []
+    for t in transactions_data:
+        if t['transaction_id'] in existing:
+            continue
+        existing.add(t['transaction_id'])
+        # Imposta una logica per il campo "direction" (questo è un esempio semplice)
+        direction = 'in' if t['amount'] < 0 else 'out'
+        date = t['date'] if not isinstance(t['date'], str) else datetime.strptime(t['date'], '%Y-%m-%d').date()
+        new_transactions.append(Transaction(
+            external_id=t['transaction_id'],
+            date=date,
+            amount=t['amount'],
+            direction=direction,
+            description=t['name'],
+            card_id=card.id,
+            category=categorizer.categorize(t['name'], t['amount']),
+            currency=t.get('iso_currency_code') or 'EUR'
+        ))
+    db.session.add_all(new_transactions)
+    return new_transactions
+
+# Applica le transazioni modificate da Plaid, mantenendo allineati i contatori di spesa
+def update_transactions(card, transactions_data):
+    by_id = {t['transaction_id']: t for t in transactions_data}
+    if not by_id:
+        return []
+    existing = Transaction.query.filter(Transaction.card_id == card.id, Transaction.external_id.in_(list(by_id))).all()
+    counted = [t for t in existing if not t.reconciliation]
+    record_transactions_spend(card.user_id, counted, sign=-1)
+    for transaction in existing:
+        t = by_id[transaction.external_id]
+        transaction.date = t['date'] if not isinstance(t['date'], str) else datetime.strptime(t['date'], '%Y-%m-%d').date()
+        transaction.amount = t['amount']
+        transaction.direction = 'in' if t['amount'] < 0 else 'out'
+        transaction.description = t['name']
+        transaction.currency = t.get('iso_currency_code') or transaction.currency
+    return record_transactions_spend(card.user_id, counted)
+
+def remove_transactions(card, external_ids):
+    if not external_ids:
+        return
+    existing = Transaction.query.filter(Transaction.card_id == card.id, Transaction.external_id.in_(external_ids)).all()
+    record_transactions_spend(card.user_id, [t for t in existing if not t.reconciliation], sign=-1)
+    removed = Transaction.query.filter(Transaction.id.in_([t.id for t in existing]))
+    record_tombstones(Transaction, card.user_id, removed)
+    # Gli abbinamenti vengono rimossi dal database tramite ON DELETE CASCADE
+    removed.delete(synchronize_session=False)
+
+# Sincronizzazione incrementale di una carta con /transactions/sync: il cursore salvato
+# sulla carta fa sì che ogni aggiornamento venga scaricato una sola volta.
+# Le carte collegate prima dei webhook non hanno l'item_id: senza, /plaid/webhook non le trova
+def ensure_plaid_item_id(card):
+    if card.plaid_item_id or not card.plaid_access_token:
+        return
+    from plaid.model.item_get_request import ItemGetRequest
+
+    response = plaid_client.item_get(ItemGetRequest(access_token=card.plaid_access_token)).to_dict()
+    card.plaid_item_id = response['item']['item_id']
+
+def sync_card(card):
+    from plaid.model.transactions_sync_request import TransactionsSyncRequest
+
+    ensure_plaid_item_id(card)
+    added, modified, removed = [], [], []
+    cursor = card.plaid_cursor
+    while True:
+        if cursor:
+            sync_request = TransactionsSyncRequest(access_token=card.plaid_access_token, cursor=cursor)
+        else:
+            sync_request = TransactionsSyncRequest(access_token=card.plaid_access_token)
+        response = plaid_client.transactions_sync(sync_request).to_dict()
+        added.extend(response.get('added', []))
+        modified.extend(response.get('modified', []))
+        removed.extend(t['transaction_id'] for t in response.get('removed', []))
+        cursor = response['next_cursor']
+        if not response.get('has_more'):
+            break
+    new_transactions = ingest_transactions(card, added)
+    alerts = record_transactions_spend(card.user_id, new_transactions)
+    alerts.extend(update_transactions(card, modified))
+    remove_transactions(card, removed)
+    card.plaid_cursor = cursor
+    db.session.commit()
+    return new_transactions, alerts
+
+# Webhook Plaid: gli eventi vengono verificati (JWT ES256 nell'header Plaid-Verification)
+# e accodati per carta. Un evento per una carta già in coda viene scartato, così una
+# raffica di notifiche produce una sola sincronizzazione dopo PLAID_WEBHOOK_COALESCE_SECONDS.
+PLAID_SYNC_WEBHOOK_CODES = ('SYNC_UPDATES_AVAILABLE', 'DEFAULT_UPDATE', 'INITIAL_UPDATE', 'HISTORICAL_UPDATE', 'TRANSACTIONS_REMOVED')
+PLAID_WEBHOOK_COALESCE_SECONDS = float(os.environ.get('PLAID_WEBHOOK_COALESCE_SECONDS', 5))
+PLAID_WEBHOOK_MAX_AGE_SECONDS = 5 * 60
+
+_webhook_keys = {}
+
+def get_webhook_key(key_id):
+    if key_id not in _webhook_keys:
+        from plaid.model.webhook_verification_key_get_request import WebhookVerificationKeyGetRequest
+        response = plaid_client.webhook_verification_key_get(WebhookVerificationKeyGetRequest(key_id=key_id))
+        _webhook_keys[key_id] = response.to_dict()['key']
+    return _webhook_keys[key_id]
+
+def verify_plaid_webhook(body, token):
+    if not token:
+        return False
+    try:
+        header = jwt.get_unverified_header(token)
+        if header.get('alg') != 'ES256':
+            return False
+        key = get_webhook_key(header['kid'])
+        if key.get('expired_at'):
+            return False
+        public_key = jwt.algorithms.ECAlgorithm.from_jwk(json.dumps(key, default=str))
+        claims = jwt.decode(token, public_key, algorithms=['ES256'])
+    except (jwt.PyJWTError, plaid.ApiException, KeyError, ValueError):
+        return False
+    if time.time() - claims.get('iat', 0) > PLAID_WEBHOOK_MAX_AGE_SECONDS:
+        return False
+    return hmac.compare_digest(hashlib.sha256(body).hexdigest(), claims.get('request_body_sha256', ''))
+
+_pending_card_syncs = set()
+_pending_lock = threading.Lock()
+
+def enqueue_card_sync(card_id):
+    with _pending_lock:
+        if card_id in _pending_card_syncs:
+            return False
+        _pending_card_syncs.add(card_id)
+    timer = threading.Timer(PLAID_WEBHOOK_COALESCE_SECONDS, run_in_background, args=(process_card_sync, card_id))
+    timer.daemon = True
+    timer.start()
+    return True
+
+def process_card_sync(card_id):
+    # Tolta dalla coda prima di sincronizzare: un evento che arriva durante il download va rielaborato
+    with _pending_lock:
+        _pending_card_syncs.discard(card_id)
+    card = Card.query.get(card_id)
+    if card is None or not card.plaid_access_token:
+        return
+    sync_card(card)
+    reconcile_user(card.user_id)
+
+# Riconciliazione: abbina spese manuali e transazioni con lo stesso importo, date vicine
+# e descrizioni simili. Le righe vengono raggruppate per importo e, in ogni gruppo,
+# ordinate per data e scorse con due puntatori sulla finestra temporale, evitando
+# il confronto di ogni spesa con ogni transazione.
+RECONCILIATION_WINDOW_DAYS = 4
+RECONCILIATION_MIN_SCORE = 0.3
+
+def description_similarity(a, b):
+    a, b = normalize_description(a), normalize_description(b)
+    if not a or not b:
+        return 0.0
+    if a in b or b in a:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+def reconcile_user(user_id):
+    user = User.query.get(user_id)
+    last_expense_id = user.reconciled_expense_id or 0
+    last_transaction_id = user.reconciled_transaction_id or 0
+    new_expense_dates = db.session.query(db.func.min(Expense.date), db.func.max(Expense.date), db.func.max(Expense.id))\
+                            .filter(Expense.user_id == user_id, Expense.id > last_expense_id).one()
+    new_transaction_dates = db.session.query(db.func.min(Transaction.date), db.func.max(Transaction.date), db.func.max(Transaction.id))\
+                                .join(Card).filter(Card.user_id == user_id, Transaction.id > last_transaction_id).one()
+    dates = [d for d in new_expense_dates[:2] + new_transaction_dates[:2] if d is not None]
+    if not dates:
+        return []
+    # Solo le righe non ancora abbinate che cadono vicino alle date delle righe nuove
+    window = timedelta(days=RECONCILIATION_WINDOW_DAYS)
+    start_date, end_date = min(dates) - window, max(dates) + window
+    expenses_list = Expense.query.outerjoin(Reconciliation, Reconciliation.expense_id == Expense.id).filter(
+        Expense.user_id == user_id, Reconciliation.id.is_(None),
+        Expense.date >= start_date, Expense.date <= end_date
+    ).all()
+    transactions_list = Transaction.query.join(Card).outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id).filter(
+        Card.user_id == user_id, Reconciliation.id.is_(None), Transaction.direction == 'out',
+        Transaction.date >= start_date, Transaction.date <= end_date
+    ).all()
+
+    buckets = {}
+    for exp in expenses_list:
+        buckets.setdefault((exp.currency or 'EUR', round(abs(exp.amount) * 100)), ([], []))[0].append(exp)
+    for t in transactions_list:
+        key = (t.currency or 'EUR', round(abs(t.amount) * 100))
+        if key in buckets:
+            buckets[key][1].append(t)
+
+    candidates = []
+    for bucket_expenses, bucket_transactions in buckets.values():
+        if not bucket_transactions:
+            continue
+        bucket_expenses.sort(key=lambda e: e.date)
+        bucket_transactions.sort(key=lambda t: t.date)
+        low = 0
+        for exp in bucket_expenses:
+            while low < len(bucket_transactions) and bucket_transactions[low].date < exp.date - window:
+                low += 1
+            i = low
+            while i < len(bucket_transactions) and bucket_transactions[i].date <= exp.date + window:
+                t = bucket_transactions[i]
+                i += 1
+                # Almeno una delle due righe deve essere nuova rispetto al passaggio precedente
+                if exp.id <= last_expense_id and t.id <= last_transaction_id:
+                    continue
+                days = abs((t.date - exp.date).days)
+                score = description_similarity(exp.description, t.description) + 0.5 * (1 - days / (RECONCILIATION_WINDOW_DAYS + 1))
+                if score >= RECONCILIATION_MIN_SCORE:
+                    candidates.append((score, exp, t))
+
+    # Assegnazione greedy: prima le coppie più probabili, ogni riga usata una sola volta
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    used_expenses, used_transactions, matches, matched_transactions = set(), set(), [], []
+    for score, exp, t in candidates:
+        if exp.id in used_expenses or t.id in used_transactions:
+            continue
+        used_expenses.add(exp.id)
+        used_transactions.add(t.id)
+        matches.append(Reconciliation(user_id=user_id, expense_id=exp.id, transaction_id=t.id, score=round(score, 3)))
+        matched_transactions.append(t)
+    db.session.add_all(matches)
+    # La spesa è già contata tramite la spesa manuale: si toglie la transazione dai contatori
+    record_transactions_spend(user_id, matched_transactions, sign=-1)
+    if new_expense_dates[2] is not None:
+        user.reconciled_expense_id = new_expense_dates[2]
+    if new_transaction_dates[2] is not None:
+        user.reconciled_transaction_id = new_transaction_dates[2]
+    db.session.commit()
+    return matches
+
+# Contatori di spesa e budget: i totali mensili per categoria vengono aggiornati
+# a ogni scrittura, così le soglie si valutano subito e la pagina dei budget
+# non deve risommare le spese del mese.
+def month_start(date):
+    return date.replace(day=1)
+
+# Budget visibili a un utente: i propri personali e quelli della sua famiglia
+def visible_budgets(user):
+    scope = (Budget.family_id.is_(None)) & (Budget.user_id == user.id)
+    if user.family_id:
+        scope = scope | (Budget.family_id == user.family_id)
+    return scope
+
+def budget_spent(budget, month):
+    query = db.session.query(db.func.sum(SpendCounter.total))\
+                .filter(SpendCounter.category == budget.category, SpendCounter.month == month)
+    if budget.family_id:
+        query = query.join(User, User.id == SpendCounter.user_id).filter(User.family_id == budget.family_id)
+    else:
+        query = query.filter(SpendCounter.user_id == budget.user_id)
+    return query.scalar() or 0.0
+
+def record_spend(user_id, category, date, delta, currency=None):
+    if not category or not delta:
+        return []
+    # I contatori sono tenuti nella valuta base dell'utente
+    user = User.query.get(user_id)
+    delta = convert_amount(delta, currency, date, user.base_currency or 'EUR')
+    month = month_start(date)
+    # Un solo INSERT ... ON CONFLICT DO UPDATE: due scritture concorrenti sul primo contatore
+    # del mese non possono violare il vincolo di unicità
+    insert = (postgresql if db.engine.dialect.name == 'postgresql' else sqlite).insert(SpendCounter.__table__)
+    db.session.execute(insert.values(user_id=user_id, category=category, month=month, total=delta)
+                       .on_conflict_do_update(index_elements=['user_id', 'category', 'month'],
+                                              set_={'total': SpendCounter.total + delta}))
+    if delta < 0:
+        return []
+    # Valuta solo i budget interessati da questa categoria; l'avviso nasce quando la soglia viene
+    # attraversata, una sola volta al mese: modifiche e spostamenti tolgono e riaggiungono l'importo
+    # e non devono ripetere l'avviso per un budget già superato
+    scope = visible_budgets(user)
+    alerts = []
+    for budget in Budget.query.filter(Budget.category == category, scope).all():
+        spent = budget_spent(budget, month)
+        if spent - delta < budget.amount <= spent and not BudgetAlert.query.filter_by(budget_id=budget.id, month=month).first():
+            owner = f"della famiglia {budget.family.name}" if budget.family else "personale"
+            alert = BudgetAlert(
+                budget_id=budget.id,
+                month=month,
+                message=f"Budget {owner} per {budget.category} superato: {round(spent, 2)}€ su {budget.amount}€ a {month.strftime('%m-%Y')}."
+            )
+            db.session.add(alert)
+            alerts.append(alert)
+    return alerts
+
+def record_transactions_spend(user_id, transactions_list, sign=1):
+    # Raggruppa per categoria e mese per aggiornare ogni contatore una sola volta
+    base = User.query.get(user_id).base_currency or 'EUR'
+    deltas = {}
+    for t in transactions_list:
+        if t.category and t.direction == 'out':
+            key = (t.category, month_start(t.date))
+            deltas[key] = deltas.get(key, 0) + sign * convert_amount(abs(t.amount), t.currency, t.date, base)
+    alerts = []
+    for (category, month), delta in deltas.items():
+        alerts.extend(record_spend(user_id, category, month, delta, base))
+    return alerts
+
+def flash_budget_alerts(alerts):
+    for alert in alerts:
+        flash(alert.message, "warning")
+
+# Operazioni in blocco: ogni azione è un solo UPDATE/DELETE filtrato per proprietario.
+# I contatori di spesa vengono corretti con una query raggruppata sulle stesse righe,
+# letta prima della modifica (giorno e valuta servono alla conversione nella valuta base).
+BULK_MAX_SHIFT_DAYS = 3650
+
+def shifted_date(column, days):
+    if db.engine.dialect.name == 'postgresql':
+        return column + days
+    return db.func.date(column, f'{days:+d} days')
+
+def owned_rows(model, user_id, ids):
+    if model is Transaction:
+        owned_cards = db.session.query(Card.id).filter(Card.user_id == user_id)
+        return model.query.filter(model.id.in_(ids), model.card_id.in_(owned_cards))
+    return model.query.filter(model.id.in_(ids), model.user_id == user_id)
+
+# Spesa per (categoria, giorno, valuta) delle righe che contano nei contatori
+def bulk_spend_rows(model, user_id, ids):
+    if model is Expense:
+        query = db.session.query(Expense.category, Expense.date, Expense.currency, db.func.sum(Expense.amount))\
+                    .filter(Expense.id.in_(ids), Expense.user_id == user_id)
+    else:
+        # Le uscite abbinate a una spesa manuale non contano: la spesa è già nei contatori
+        query = db.session.query(Transaction.category, Transaction.date, Transaction.currency, db.func.sum(db.func.abs(Transaction.amount)))\
+                    .join(Card, Card.id == Transaction.card_id)\
+                    .outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                    .filter(Transaction.id.in_(ids), Card.user_id == user_id,
+                            Transaction.direction == 'out', Reconciliation.id.is_(None))
+    return query.group_by(model.category, model.date, model.currency).all()
+
+def apply_spend_rows(user_id, rows, sign=1, category=None, days=0):
+    base = User.query.get(user_id).base_currency or 'EUR'
+    deltas = {}
+    for row_category, date, currency, total in rows:
+        date += timedelta(days=days)
+        key = (category or row_category, month_start(date))
+        deltas[key] = deltas.get(key, 0) + sign * convert_amount(total, currency or 'EUR', date, base)
+    alerts = []
+    for (row_category, month), delta in deltas.items():
+        alerts.extend(record_spend(user_id, row_category, month, delta, base))
+    return alerts
+
+def bulk_update(model, user_id, ids, action, category=None, days=0):
+    counted = model in (Expense, Transaction)
+    rows = bulk_spend_rows(model, user_id, ids) if counted else []
+    if action == 'delete':
+        if model is Expense:
+            # Le transazioni abbinate alle spese eliminate tornano a contare da sole
+            partners = Transaction.query.join(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                            .join(Expense, Expense.id == Reconciliation.expense_id)\
+                            .filter(Expense.id.in_(ids), Expense.user_id == user_id).all()
+            record_transactions_spend(user_id, partners)
+        record_tombstones(model, user_id, owned_rows(model, user_id, ids))
+        # Gli abbinamenti vengono rimossi dal database tramite ON DELETE CASCADE
+        count = owned_rows(model, user_id, ids).delete(synchronize_session=False)
+        apply_spend_rows(user_id, rows, sign=-1)
+        return count, []
+    values = bulk_change_values(model, user_id)
+    if action == 'category':
+        values[model.category] = category
+    else:
+        values[model.date] = shifted_date(model.date, days)
+    count = owned_rows(model, user_id, ids).update(values, synchronize_session=False)
+    apply_spend_rows(user_id, rows, sign=-1)
+    return count, apply_spend_rows(user_id, rows, category=category, days=days)
+
+# Ricostruisce i contatori dai dati esistenti (ad esempio dopo la migrazione)
+def rebuild_spend_counters(user_id=None):
+    query = SpendCounter.query
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    query.delete(synchronize_session=False)
+    expenses_rows = db.session.query(Expense.user_id, Expense.category, Expense.date, Expense.currency, db.func.sum(Expense.amount))\
+                        .filter(Expense.user_id.isnot(None))
+    transactions_rows = db.session.query(Card.user_id, Transaction.category, Transaction.date, Transaction.currency, db.func.sum(db.func.abs(Transaction.amount)))\
+                            .join(Card).outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                            .filter(Transaction.category.isnot(None), Transaction.direction == 'out', Reconciliation.id.is_(None))
+    if user_id is not None:
+        expenses_rows = expenses_rows.filter(Expense.user_id == user_id)
+        transactions_rows = transactions_rows.filter(Card.user_id == user_id)
+    bases = dict(db.session.query(User.id, User.base_currency).all())
+    totals = {}
+    for rows in (expenses_rows.group_by(Expense.user_id, Expense.category, Expense.date, Expense.currency),
+                 transactions_rows.group_by(Card.user_id, Transaction.category, Transaction.date, Transaction.currency)):
+        for uid, category, date, currency, total in rows.all():
+            key = (uid, category, month_start(date))
+            totals[key] = totals.get(key, 0) + convert_amount(total, currency, date, bases.get(uid) or 'EUR')
+    # Le righe archiviate contano attraverso i loro totali mensili
+    rollups = db.session.query(ArchiveRollup.user_id, ArchiveRollup.category, ArchiveRollup.month, ArchiveRollup.total)\
+                .filter(ArchiveRollup.kind.in_(['expense', 'transaction_out']))
+    if user_id is not None:
+        rollups = rollups.filter(ArchiveRollup.user_id == user_id)
+    for uid, category, month, total in rollups.all():
+        key = (uid, category, month)
+        totals[key] = totals.get(key, 0) + total
+    db.session.add_all([SpendCounter(user_id=uid, category=category, month=month, total=total)
+                        for (uid, category, month), total in totals.items()])
+    db.session.commit()
+
+@app.cli.command('rebuild-spend-counters')
+def rebuild_spend_counters_command():
+    rebuild_spend_counters()
+    print("Contatori di spesa ricostruiti.")
+
+# Archiviazione dei dati freddi: spese e transazioni più vecchie dell'orizzonte
+# configurato vengono scritte in segmenti CSV compressi, uno per utente, tipo e anno,
+# e rimosse dalle tabelle. I totali restano in ArchiveRollup e le pagine leggono
+# i segmenti solo quando l'intervallo richiesto arriva prima di User.archived_before.
+ARCHIVE_FIELDS = {
+    'expense': ['id', 'date', 'amount', 'category', 'description', 'user_id', 'currency'],
+    'transaction': ['id', 'external_id', 'date', 'amount', 'direction', 'description', 'card_id', 'category', 'reconciled_expense_id', 'currency'],
+}
+
+def archive_segment_path(user_id, kind, year):
+    return os.path.join(app.config['ARCHIVE_FOLDER'], str(user_id), f"{kind}-{year}.csv.gz")
+
+# Le righe vengono aggiunte a una copia del segmento ('.pending'), che sostituisce l'originale
+# solo dopo il commit delle cancellazioni (publish_archive_segments): se il commit fallisce
+# il segmento resta invariato e le righe, ancora nel database, non vengono archiviate due volte
+ARCHIVE_PENDING_SUFFIX = '.pending'
+
+def write_archive_rows(user_id, kind, rows):
+    by_year = {}
+    for row in rows:
+        by_year.setdefault(row['date'].year, []).append(row)
+    pending_paths = []
+    for year, year_rows in by_year.items():
+        path = archive_segment_path(user_id, kind, year)
+        pending = path + ARCHIVE_PENDING_SUFFIX
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        new_file = not os.path.exists(path)
+        if not new_file:
+            shutil.copyfile(path, pending)
+        pending_paths.append(pending)
+        # gzip in append aggiunge un nuovo membro al file, che resta leggibile come un unico flusso
+        with gzip.open(pending, 'at', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=ARCHIVE_FIELDS[kind])
+            if new_file:
+                writer.writeheader()
+            writer.writerows(year_rows)
+    return pending_paths
+
+def publish_archive_segments(pending_paths):
+    for pending in pending_paths:
+        os.replace(pending, pending[:-len(ARCHIVE_PENDING_SUFFIX)])
+
+# Copie rimaste da un'archiviazione interrotta tra il commit e la pubblicazione: se l'ultima
+# riga aggiunta non è più nel database il commit è avvenuto e la copia va pubblicata,
+# altrimenti viene scartata
+def recover_archive_segments(user_id):
+    folder = os.path.join(app.config['ARCHIVE_FOLDER'], str(user_id))
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if not name.endswith(ARCHIVE_PENDING_SUFFIX):
+            continue
+        pending = os.path.join(folder, name)
+        model = Expense if name.startswith('expense-') else Transaction
+        rows = read_archive_segment(pending)
+        _archive_cache.pop(pending, None)
+        # Anche la data: SQLite può riassegnare l'id di una riga cancellata
+        if rows and db.session.query(model.id).filter(model.id == rows[-1].id, model.date == rows[-1].date).first() is None:
+            publish_archive_segments([pending])
+        else:
+            os.remove(pending)
+
+_archive_cache = {}
+
+def read_archive_segment(path):
+    mtime = os.path.getmtime(path)
+    cached = _archive_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    rows = []
+    with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            # Ogni membro gzip aggiunto in append ripete l'intestazione
+            if row['id'] == 'id':
+                continue
+            row['id'] = int(row['id'])
+            row['date'] = datetime.strptime(row['date'], '%Y-%m-%d').date()
+            row['amount'] = float(row['amount'])
+            for key in ('user_id', 'card_id', 'reconciled_expense_id'):
+                if key in row:
+                    row[key] = int(row[key]) if row[key] else None
+            for key in ('category', 'description', 'external_id'):
+                if key in row:
+                    row[key] = row[key] or None
+            row['currency'] = row.get('currency') or 'EUR'
+            rows.append(SimpleNamespace(**row))
+    _archive_cache[path] = (mtime, rows)
+    return rows
+
+# Righe archiviate con start_date <= data < end_date
+def load_archived(user_id, kind, start_date, end_date):
+    rows = []
+    for year in range(start_date.year, end_date.year + 1):
+        path = archive_segment_path(user_id, kind, year)
+        if os.path.exists(path):
+            rows.extend(r for r in read_archive_segment(path) if start_date <= r.date < end_date)
+    return rows
+
+def archived_totals(user_id, kinds, start_date=None, end_date=None):
+    query = db.session.query(ArchiveRollup.kind, ArchiveRollup.category, db.func.sum(ArchiveRollup.total))\
+                .filter(ArchiveRollup.user_id == user_id, ArchiveRollup.kind.in_(kinds))
+    if start_date is not None:
+        query = query.filter(ArchiveRollup.month >= start_date, ArchiveRollup.month < end_date)
+    return query.group_by(ArchiveRollup.kind, ArchiveRollup.category).all()
+
+def add_archive_rollup(user_id, kind, category, date, amount):
+    month = month_start(date)
+    updated = ArchiveRollup.query.filter_by(user_id=user_id, kind=kind, category=category, month=month)\
+                .update({ArchiveRollup.total: ArchiveRollup.total + amount,
+                         ArchiveRollup.count: ArchiveRollup.count + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(ArchiveRollup(user_id=user_id, kind=kind, category=category, month=month, total=amount, count=1))
+        db.session.flush()
+
+def archive_user_data(user_id, cutoff):
+    recover_archive_segments(user_id)
+    # Una coppia riconciliata si archivia solo se entrambe le righe sono oltre l'orizzonte
+    partner = db.aliased(Transaction)
+    expenses_old = Expense.query.outerjoin(Reconciliation, Reconciliation.expense_id == Expense.id)\
+                        .outerjoin(partner, partner.id == Reconciliation.transaction_id)\
+                        .filter(Expense.user_id == user_id, Expense.date < cutoff,
+                                (Reconciliation.id.is_(None)) | (partner.date < cutoff)).all()
+    partner_expense = db.aliased(Expense)
+    transactions_old = db.session.query(Transaction, Reconciliation)\
+                            .join(Card).outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                            .outerjoin(partner_expense, partner_expense.id == Reconciliation.expense_id)\
+                            .filter(Card.user_id == user_id, Transaction.date < cutoff,
+                                    (Reconciliation.id.is_(None)) | (partner_expense.date < cutoff)).all()
+    # Le righe senza cambio verso la valuta base restano nel database finché il cambio non viene
+    # caricato: il totale archiviato le conterebbe per sempre come zero. Le coppie riconciliate
+    # restano insieme.
+    base = User.query.get(user_id).base_currency or 'EUR'
+    partners = dict(db.session.query(Reconciliation.expense_id, Reconciliation.transaction_id)
+                        .filter(Reconciliation.user_id == user_id).all())
+    expenses_old = [e for e in expenses_old if convertible(e.currency, e.date, base)]
+    kept_expenses = {e.id for e in expenses_old}
+    transactions_old = [(t, r) for t, r in transactions_old
+                        if convertible(t.currency, t.date, base) and (r is None or r.expense_id in kept_expenses)]
+    kept_transactions = {t.id for t, _ in transactions_old}
+    expenses_old = [e for e in expenses_old if e.id not in partners or partners[e.id] in kept_transactions]
+    if not expenses_old and not transactions_old:
+        return 0, 0
+
+    pending_paths = write_archive_rows(user_id, 'expense', [
+        {'id': e.id, 'date': e.date, 'amount': e.amount, 'category': e.category,
+         'description': e.description, 'user_id': e.user_id, 'currency': e.currency} for e in expenses_old])
+    pending_paths += write_archive_rows(user_id, 'transaction', [
+        {'id': t.id, 'external_id': t.external_id, 'date': t.date, 'amount': t.amount, 'direction': t.direction,
+         'description': t.description, 'card_id': t.card_id, 'category': t.category,
+         'reconciled_expense_id': r.expense_id if r else None, 'currency': t.currency} for t, r in transactions_old])
+
+    # I totali seguono le stesse regole delle pagine: transazioni solo se categorizzate e non riconciliate,
+    # importi convertiti nella valuta base dell'utente
+    for e in expenses_old:
+        add_archive_rollup(user_id, 'expense', e.category, e.date, convert_amount(e.amount, e.currency, e.date, base))
+    for t, r in transactions_old:
+        if t.category and r is None:
+            add_archive_rollup(user_id, 'transaction_' + t.direction, t.category, t.date,
+                               convert_amount(abs(t.amount), t.currency, t.date, base))
+
+    expense_ids = [e.id for e in expenses_old]
+    transaction_ids = [t.id for t, _ in transactions_old]
+    # Cancellazioni set-based a blocchi, senza caricare le relazioni riga per riga
+    for i in range(0, max(len(expense_ids), len(transaction_ids)), 500):
+        expense_chunk = expense_ids[i:i + 500]
+        transaction_chunk = transaction_ids[i:i + 500]
+        # Le ricevute restano, collegate all'id della riga archiviata invece che alla riga stessa
+        if expense_chunk:
+            Receipt.query.filter(Receipt.expense_id.in_(expense_chunk))\
+                .update({Receipt.archived_expense_id: Receipt.expense_id, Receipt.expense_id: None}, synchronize_session=False)
+            Reconciliation.query.filter(Reconciliation.expense_id.in_(expense_chunk)).delete(synchronize_session=False)
+        if transaction_chunk:
+            Receipt.query.filter(Receipt.transaction_id.in_(transaction_chunk))\
+                .update({Receipt.archived_transaction_id: Receipt.transaction_id, Receipt.transaction_id: None}, synchronize_session=False)
+            Reconciliation.query.filter(Reconciliation.transaction_id.in_(transaction_chunk)).delete(synchronize_session=False)
+            Transaction.query.filter(Transaction.id.in_(transaction_chunk)).delete(synchronize_session=False)
+        if expense_chunk:
+            Expense.query.filter(Expense.id.in_(expense_chunk)).delete(synchronize_session=False)
+    user = User.query.get(user_id)
+    user.archived_before = max(user.archived_before or cutoff, cutoff)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for pending in pending_paths:
+            os.remove(pending)
+        raise
+    publish_archive_segments(pending_paths)
+    return len(expense_ids), len(transaction_ids)
+
+@app.cli.command('archive-old-data')
+def archive_old_data_command():
+    cutoff = datetime.now().date() - timedelta(days=app.config['ARCHIVE_HORIZON_DAYS'])
+    for (user_id,) in db.session.query(User.id).all():
+        archived_expenses, archived_transactions = archive_user_data(user_id, cutoff)
+        if archived_expenses or archived_transactions:
+            print(f"Utente {user_id}: archiviate {archived_expenses} spese e {archived_transactions} transazioni.")
+
+# Cancellazione account: la richiesta marca l'utente come eliminato e la pulizia
+# dei dati avviene in background, a blocchi di PURGE_BATCH_SIZE righe con un commit
+# per blocco, così il lock in scrittura non viene mai tenuto a lungo.
+PURGE_BATCH_SIZE = 1000
+
+def purge_in_batches(model, *conditions):
+    while True:
+        ids = [row[0] for row in db.session.query(model.id).filter(*conditions).limit(PURGE_BATCH_SIZE).all()]
+        if not ids:
+            break
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+def purge_user(user_id):
+    card_ids = db.session.query(Card.id).filter(Card.user_id == user_id)
+    budget_ids = db.session.query(Budget.id).filter(Budget.user_id == user_id)
+    # Prima le tabelle figlie, così ogni DELETE ha poco lavoro di cascata
+    purge_in_batches(Reconciliation, Reconciliation.user_id == user_id)
+    purge_in_batches(BudgetAlert, BudgetAlert.budget_id.in_(budget_ids))
+    purge_in_batches(Transaction, Transaction.card_id.in_(card_ids))
+    for model in (Expense, Income, Loan, RecurringPayment, CategoryRule, Budget, SpendCounter, ArchiveRollup, Tombstone, Card):
+        purge_in_batches(model, model.user_id == user_id)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    shutil.rmtree(os.path.join(app.config['ARCHIVE_FOLDER'], str(user_id)), ignore_errors=True)
+
+# Riprende le cancellazioni interrotte (ad esempio da un riavvio del server)
+@app.cli.command('purge-deleted-accounts')
+def purge_deleted_accounts_command():
+    for (user_id,) in db.session.query(User.id).filter(User.deleted_at.isnot(None)).all():
+        purge_user(user_id)
+        print(f"Utente {user_id} eliminato.")
+
+# Famiglie: ogni interrogazione a livello di famiglia unisce in un'unica query i membri
+# (filtrati per family_id indicizzato) con le loro spese, invece di una query per membro.
+def get_or_create_family(name):
+    name = (name or '').strip()
+    if not name:
+        return None
+    family = Family.query.filter_by(name=name).first()
+    if not family:
+        family = Family(name=name)
+        db.session.add(family)
+    return family
+
+def family_members(family_id):
+    return User.query.filter_by(family_id=family_id, deleted_at=None).order_by(User.username).all()
+
+def family_expense_totals(family_id, base_currency):
+    columns, group = currency_group_columns(Expense, Expense.amount, base_currency)
+    rows = db.session.query(Expense.user_id, *columns)\
+                .join(User, User.id == Expense.user_id)\
+                .filter(User.family_id == family_id)\
+                .group_by(Expense.user_id, *group).all()
+    return converted_totals(rows, base_currency, keys=1)
+
+def family_archived_totals(family_id):
+    rows = db.session.query(ArchiveRollup.user_id, db.func.sum(ArchiveRollup.total))\
+                .join(User, User.id == ArchiveRollup.user_id)\
+                .filter(User.family_id == family_id, ArchiveRollup.kind == 'expense')\
+                .group_by(ArchiveRollup.user_id).all()
+    return dict(rows)
+
+# Spesa più recente e spesa maggiore di ogni membro, con una sola query a finestra
+def family_expense_highlights(family_id):
+    ranked = db.session.query(
+        Expense.id.label('id'),
+        db.func.row_number().over(partition_by=Expense.user_id, order_by=(Expense.date.desc(), Expense.id.desc())).label('recent_rank'),
+        db.func.row_number().over(partition_by=Expense.user_id, order_by=(Expense.amount.desc(), Expense.id.desc())).label('largest_rank')
+    ).join(User, User.id == Expense.user_id).filter(User.family_id == family_id).subquery()
+    rows = db.session.query(Expense, ranked.c.recent_rank, ranked.c.largest_rank)\
+                .join(ranked, ranked.c.id == Expense.id)\
+                .filter((ranked.c.recent_rank == 1) | (ranked.c.largest_rank == 1)).all()
+    recent, largest = {}, {}
+    for expense, recent_rank, largest_rank in rows:
+        if recent_rank == 1:
+            recent[expense.user_id] = expense
+        if largest_rank == 1:
+            largest[expense.user_id] = expense
+    return recent, largest
+
+def family_high_expenses(family_id, threshold, since):
+    return db.session.query(User.username, Expense)\
+                .join(Expense, Expense.user_id == User.id)\
+                .filter(User.family_id == family_id, Expense.amount >= threshold, Expense.date >= since)\
+                .order_by(Expense.date).all()
 
 # Aggiungiamo il decorator per proteggere le route
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if get_current_user() is None:
+            session.pop('user_id', None)
             flash("Devi essere loggato per accedere a questa pagina.", "warning")
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
+# Dashboard della home: un numero fisso di query aggregate, indipendente dal volume dei
+# dati, con il risultato in cache per utente. La versione è la somma delle sequenze di
+# modifica dell'utente e dei familiari (i budget di famiglia dipendono dalle loro spese):
+# ogni scrittura la fa avanzare e la copia in cache non viene più usata.
+DASHBOARD_CACHE_SIZE = 1024
+DASHBOARD_CACHE_SECONDS = 300
+DASHBOARD_DUE_DAYS = 7
+_dashboard_cache = OrderedDict()
+_dashboard_lock = threading.Lock()
+
+def dashboard_version(user):
+    query = db.session.query(db.func.sum(User.change_seq))
+    if user.family_id:
+        query = query.filter((User.id == user.id) | (User.family_id == user.family_id))
+    else:
+        query = query.filter(User.id == user.id)
+    return query.scalar() or 0
+
+def build_dashboard(user, today):
+    month = month_start(today)
+    total_incomes, total_expenses = balance_totals(user, month, today + timedelta(days=1))
+    # Scadenze di prestiti e pagamenti ricorrenti in un'unica query
+    threshold = today + timedelta(days=DASHBOARD_DUE_DAYS)
+    dues = db.union_all(
+        db.select(db.literal('loan').label('kind'), Loan.name, Loan.amount, Loan.due_date, Loan.type.label('detail'))
+            .where(Loan.user_id == user.id, Loan.due_date <= threshold),
+        db.select(db.literal('recurring').label('kind'), RecurringPayment.name, RecurringPayment.amount,
+                  RecurringPayment.due_date, RecurringPayment.recurrence.label('detail'))
+            .where(RecurringPayment.user_id == user.id, RecurringPayment.due_date <= threshold)
+    ).subquery()
+    due_rows = db.session.query(dues).order_by(dues.c.due_date).limit(10).all()
+    latest = db.session.query(Transaction.date, Transaction.description, Transaction.amount, Transaction.currency,
+                              Transaction.direction, Card.card_name)\
+                .join(Card).filter(Card.user_id == user.id)\
+                .order_by(Transaction.date.desc(), Transaction.id.desc()).limit(5).all()
+    return {
+        "month": month,
+        "currency": user.base_currency or 'EUR',
+        "incomes": total_incomes,
+        "expenses": total_expenses,
+        "balance": round(total_incomes - total_expenses, 2),
+        "dues": [{"kind": row.kind, "name": row.name, "amount": row.amount, "due_date": row.due_date,
+                  "detail": row.detail, "overdue": row.due_date < today} for row in due_rows],
+        "transactions": [row._asdict() for row in latest],
+        "budgets": [{"category": item["budget"].category, "family": bool(item["budget"].family_id),
+                     "amount": item["budget"].amount, "spent": item["spent"], "percent": item["percent"]}
+                    for item in budget_status(user, month)],
+        "unconverted": sorted(g.get('unconverted_currencies', ())),
+    }
+
+def dashboard_summary(user):
+    today = datetime.now().date()
+    key = (dashboard_version(user), user.base_currency or 'EUR', exchange_rates_version(), today)
+    now = time.monotonic()
+    with _dashboard_lock:
+        cached = _dashboard_cache.get(user.id)
+        if cached and cached[0] == key and now - cached[1] < DASHBOARD_CACHE_SECONDS:
+            # La copia in cache non passa da convert_amount: riporta le valute non convertite
+            g.setdefault('unconverted_currencies', set()).update(cached[2]['unconverted'])
+            return cached[2]
+    data = build_dashboard(user, today)
+    with _dashboard_lock:
+        _dashboard_cache[user.id] = (key, now, data)
+        _dashboard_cache.move_to_end(user.id)
+        if len(_dashboard_cache) > DASHBOARD_CACHE_SIZE:
+            _dashboard_cache.popitem(last=False)
+    return data
+
 @app.route('/')
 def index():
-    notifications = get_due_notifications()
-    return render_template('index.html', notifications=notifications)
+    user = get_current_user()
+    if user is None:
+        return render_template('index.html', dashboard=None)
+    return render_template('index.html', dashboard=dashboard_summary(user))
 
 @app.route('/expenses', methods=['GET', 'POST'])
 @login_required
 def expenses():
     if request.method == 'POST':
+        currency = request.form.get('currency') or 'EUR'
+        if currency not in CURRENCIES:
+            flash("Valuta non supportata", "danger")
+            return redirect(url_for('expenses'))
         date_str = request.form.get('date')
         if date_str:
             date = datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -144,11 +1418,15 @@ def expenses():
             amount=float(request.form['amount']),
             category=request.form['category'],
             description=request.form.get('description'),
-            user_id=session['user_id']
+            user_id=session['user_id'],
+            currency=currency
         )
         db.session.add(new_expense)
+        alerts = record_spend(new_expense.user_id, new_expense.category, new_expense.date, new_expense.amount, new_expense.currency)
         db.session.commit()
+        reconcile_user(session['user_id'])
         flash("Spesa aggiunta con successo!", "success")
+        flash_budget_alerts(alerts)
         return redirect(url_for('expenses'))
     expenses_list = Expense.query.filter_by(user_id=session['user_id']).order_by(Expense.date.desc()).all()
     return render_template('expenses.html', expenses=expenses_list)
@@ -157,6 +1435,10 @@ def expenses():
 @login_required
 def incomes():
     if request.method == 'POST':
+        currency = request.form.get('currency') or 'EUR'
+        if currency not in CURRENCIES:
+            flash("Valuta non supportata", "danger")
+            return redirect(url_for('incomes'))
         date_str = request.form.get('date')
         if date_str:
             date = datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -167,7 +1449,8 @@ def incomes():
             amount=float(request.form['amount']),
             category=request.form['category'],
             description=request.form.get('description'),
-            user_id=session['user_id']
+            user_id=session['user_id'],
+            currency=currency
         )
         db.session.add(new_income)
         db.session.commit()
@@ -176,6 +1459,46 @@ def incomes():
     incomes_list = Income.query.filter_by(user_id=session['user_id']).order_by(Income.date.desc()).all()
     return render_template('incomes.html', incomes=incomes_list)
 
+# Totali di entrate e spese nella valuta base, nell'intervallo [start_date, end_date) o su tutto lo storico
+def balance_totals(user, start_date=None, end_date=None):
+    base = user.base_currency or 'EUR'
+
+    def in_range(column):
+        if start_date is None:
+            return db.true()
+        return db.and_(column >= start_date, column < end_date)
+
+    columns, group = currency_group_columns(Expense, Expense.amount, base)
+    expenses_rows = db.session.query(*columns).filter(
+        in_range(Expense.date),
+        Expense.user_id == user.id
+    ).group_by(*group).all()
+    columns, group = currency_group_columns(Income, Income.amount, base)
+    incomes_rows = db.session.query(*columns).filter(
+        in_range(Income.date),
+        Income.user_id == user.id
+    ).group_by(*group).all()
+    # Le transazioni sincronizzate contano nel bilancio solo una volta categorizzate
+    # e se non sono già abbinate a una spesa inserita a mano
+    columns, group = currency_group_columns(Transaction, db.func.abs(Transaction.amount), base)
+    transactions_rows = db.session.query(Transaction.direction, *columns)\
+                            .join(Card).outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                            .filter(
+                                Card.user_id == user.id,
+                                Transaction.category.isnot(None),
+                                Reconciliation.id.is_(None),
+                                in_range(Transaction.date)
+                            ).group_by(Transaction.direction, *group).all()
+    transactions_totals = converted_totals(transactions_rows, base, keys=1)
+    # Per i mesi archiviati si aggiungono i totali conservati in ArchiveRollup
+    if user.archived_before and (start_date is None or start_date < user.archived_before):
+        for kind, _, total in archived_totals(user.id, ['expense', 'transaction_in', 'transaction_out'], start_date, end_date):
+            key = 'out' if kind in ('expense', 'transaction_out') else 'in'
+            transactions_totals[key] = (transactions_totals.get(key) or 0) + total
+    total_expenses = round(converted_totals(expenses_rows, base).get(None, 0) + (transactions_totals.get('out') or 0), 2)
+    total_incomes = round(converted_totals(incomes_rows, base).get(None, 0) + (transactions_totals.get('in') or 0), 2)
+    return total_incomes, total_expenses
+
 @app.route('/balance', methods=['GET', 'POST'])
 @login_required
 def balance():
@@ -198,40 +1521,411 @@ def balance():
     else:
         end_date = datetime(year, month + 1, 1).date()
     
-    expenses_list = Expense.query.filter(
-        Expense.date >= start_date, Expense.date < end_date,
-        Expense.user_id == session['user_id']
-    ).all()
-    incomes_list = Income.query.filter(
-        Income.date >= start_date, Income.date < end_date,
-        Income.user_id == session['user_id']
-    ).all()
-    total_expenses = sum(exp.amount for exp in expenses_list)
-    total_incomes = sum(inc.amount for inc in incomes_list)
-    balance_value = total_incomes - total_expenses
-    return render_template('balance.html', balance=balance_value, total_expenses=total_expenses, total_incomes=total_incomes, year=year, month=month)
+    # Tutti i totali sono espressi nella valuta base dell'utente
+    user = User.query.get(session['user_id'])
+    base = user.base_currency or 'EUR'
+    total_incomes, total_expenses = balance_totals(user, start_date, end_date)
+    balance_value = round(total_incomes - total_expenses, 2)
+    return render_template('balance.html', balance=balance_value, total_expenses=total_expenses, total_incomes=total_incomes, year=year, month=month, currency=base)
+
+# Serie dei grafici: gli importi vengono raggruppati per periodo direttamente in SQL,
+# i segmenti archiviati (fuori dal database) vengono raggruppati in Python
+CHART_GRANULARITIES = ('day', 'week', 'month')
+CHART_DIMENSIONS = ('category', 'card', 'member')
+CHART_MAX_BUCKETS = 1000
+CHART_MAX_AGE_SECONDS = 60
+
+def date_bucket(column, granularity):
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.to_char(db.func.date_trunc(granularity, column), 'YYYY-MM-DD')
+    if granularity == 'month':
+        return db.func.strftime('%Y-%m-01', column)
+    if granularity == 'week':
+        # Lunedì della settimana: domenica successiva (o stessa) meno sei giorni
+        return db.func.date(column, 'weekday 0', '-6 days')
+    return db.func.date(column)
+
+def bucket_start(date, granularity):
+    if granularity == 'month':
+        return date.replace(day=1)
+    if granularity == 'week':
+        return date - timedelta(days=date.weekday())
+    return date
+
+def chart_buckets(start_date, end_date, granularity):
+    buckets = []
+    current = bucket_start(start_date, granularity)
+    while current < end_date and len(buckets) <= CHART_MAX_BUCKETS:
+        buckets.append(current.isoformat())
+        if granularity == 'month':
+            current = (current + timedelta(days=32)).replace(day=1)
+        else:
+            current += timedelta(days=7 if granularity == 'week' else 1)
+    return buckets
+
+def chart_series(user, start_date, end_date, granularity, dimension):
+    base = user.base_currency or 'EUR'
+    members = family_members(user.family_id) if dimension == 'member' and user.family_id else [user]
+    user_ids = [member.id for member in members]
+    totals = {}
+
+    def add(bucket, label, amount):
+        series = totals.setdefault(label or 'Non categorizzato', {})
+        series[bucket] = series.get(bucket, 0) + amount
+
+    # Spese manuali: per la dimensione "card" finiscono tutte in un'unica serie
+    bucket = date_bucket(Expense.date, granularity)
+    labels = {'category': [Expense.category], 'card': [], 'member': [User.username]}[dimension]
+    columns, group = currency_group_columns(Expense, Expense.amount, base)
+    rows = db.session.query(bucket, *labels, *columns).select_from(Expense)\
+                .join(User, User.id == Expense.user_id)\
+                .filter(Expense.user_id.in_(user_ids), Expense.date >= start_date, Expense.date < end_date)\
+                .group_by(bucket, *labels, *group).all()
+    for key, amount in converted_totals(rows, base, keys=1 + len(labels)).items():
+        if labels:
+            add(str(key[0]), key[1], amount)
+        else:
+            add(str(key), 'Spese manuali', amount)
+
+    # Uscite dalle carte già categorizzate e non abbinate a una spesa manuale, come in bilancio e grafici
+    bucket = date_bucket(Transaction.date, granularity)
+    label = {'category': Transaction.category, 'card': Card.card_name, 'member': User.username}[dimension]
+    columns, group = currency_group_columns(Transaction, db.func.abs(Transaction.amount), base)
+    rows = db.session.query(bucket, label, *columns).select_from(Transaction)\
+                .join(Card, Card.id == Transaction.card_id).join(User, User.id == Card.user_id)\
+                .outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                .filter(Card.user_id.in_(user_ids), Transaction.direction == 'out', Transaction.category.isnot(None),
+                        Reconciliation.id.is_(None), Transaction.date >= start_date, Transaction.date < end_date)\
+                .group_by(bucket, label, *group).all()
+    for (bucket_key, label_key), amount in converted_totals(rows, base, keys=2).items():
+        add(str(bucket_key), label_key, amount)
+
+    # Periodo archiviato
+    card_names = dict(db.session.query(Card.id, Card.card_name).filter(Card.user_id.in_(user_ids)).all())
+    for member in members:
+        if not member.archived_before or start_date >= member.archived_before:
+            continue
+        archive_end = min(end_date, member.archived_before)
+        for row in load_archived(member.id, 'expense', start_date, archive_end):
+            amount = convert_amount(row.amount, row.currency, row.date, base)
+            label_key = {'category': row.category, 'card': 'Spese manuali', 'member': member.username}[dimension]
+            add(bucket_start(row.date, granularity).isoformat(), label_key, amount)
+        for row in load_archived(member.id, 'transaction', start_date, archive_end):
+            if row.direction != 'out' or not row.category or row.reconciled_expense_id:
+                continue
+            amount = convert_amount(abs(row.amount), row.currency, row.date, base)
+            label_key = {'category': row.category, 'card': card_names.get(row.card_id, 'Carta eliminata'), 'member': member.username}[dimension]
+            add(bucket_start(row.date, granularity).isoformat(), label_key, amount)
+
+    buckets = chart_buckets(start_date, end_date, granularity)
+    series = []
+    for label_key in sorted(totals):
+        values = [round(totals[label_key].get(b, 0), 2) for b in buckets]
+        series.append({"label": label_key, "data": values, "total": round(sum(values), 2)})
+    return {"currency": base, "buckets": buckets, "series": series}
 
 @app.route('/charts')
 @login_required
 def charts():
     user_id = session.get('user_id')
-    # Accumula i dati delle categorie in spese e entrate per l'utente corrente
-    expenses_data = db.session.query(Expense.category, db.func.sum(Expense.amount))\
+    base = User.query.get(user_id).base_currency or 'EUR'
+    # Accumula i dati delle categorie in spese e entrate per l'utente corrente, convertiti nella valuta base
+    columns, group = currency_group_columns(Expense, Expense.amount, base)
+    expenses_data = db.session.query(Expense.category, *columns)\
                         .filter(Expense.user_id == user_id)\
-                        .group_by(Expense.category).all()
-    incomes_data = db.session.query(Income.category, db.func.sum(Income.amount))\
+                        .group_by(Expense.category, *group).all()
+    columns, group = currency_group_columns(Income, Income.amount, base)
+    incomes_data = db.session.query(Income.category, *columns)\
                         .filter(Income.user_id == user_id)\
-                        .group_by(Income.category).all()
-    expenses_categories = [cat for cat, _ in expenses_data]
-    expenses_values = [val for _, val in expenses_data]
-    incomes_categories = [cat for cat, _ in incomes_data]
-    incomes_values = [val for _, val in incomes_data]
+                        .group_by(Income.category, *group).all()
+    columns, group = currency_group_columns(Transaction, db.func.abs(Transaction.amount), base)
+    transactions_data = db.session.query(Transaction.category, *columns)\
+                        .join(Card).outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                        .filter(Card.user_id == user_id, Transaction.category.isnot(None),
+                                Transaction.direction == 'out', Reconciliation.id.is_(None))\
+                        .group_by(Transaction.category, *group).all()
+    # Unisce le spese manuali con le transazioni categorizzate
+    expenses_totals = converted_totals(expenses_data, base, keys=1)
+    for cat, val in converted_totals(transactions_data, base, keys=1).items():
+        expenses_totals[cat] = expenses_totals.get(cat, 0) + val
+    for _, cat, val in archived_totals(user_id, ['expense', 'transaction_out']):
+        expenses_totals[cat] = expenses_totals.get(cat, 0) + val
+    incomes_totals = converted_totals(incomes_data, base, keys=1)
+    expenses_categories = list(expenses_totals)
+    expenses_values = [round(val, 2) for val in expenses_totals.values()]
+    incomes_categories = list(incomes_totals)
+    incomes_values = [round(val, 2) for val in incomes_totals.values()]
     return render_template('charts.html', 
                            expenses_categories=expenses_categories, 
                            expenses_values=expenses_values,
                            incomes_categories=incomes_categories,
                            incomes_values=incomes_values)
 
+# Dati dei grafici in JSON: ?start=AAAA-MM-GG&end=AAAA-MM-GG&granularity=day|week|month&dimension=category|card|member
+@app.route('/api/charts')
+@login_required
+def api_charts():
+    user = User.query.get(session['user_id'])
+    today = datetime.now().date()
+    granularity = request.args.get('granularity', 'month')
+    dimension = request.args.get('dimension', 'category')
+    if granularity not in CHART_GRANULARITIES or dimension not in CHART_DIMENSIONS:
+        return jsonify({"error": "granularità o dimensione non valida"}), 400
+    try:
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else today
+        if request.args.get('start'):
+            start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        else:
+            # Ultimi dodici mesi, mese corrente compreso
+            months = end_date.year * 12 + end_date.month - 12
+            start_date = datetime(months // 12, months % 12 + 1, 1).date()
+    except ValueError:
+        return jsonify({"error": "data non valida"}), 400
+    # La data finale è inclusa
+    end_date += timedelta(days=1)
+    if start_date >= end_date or len(chart_buckets(start_date, end_date, granularity)) > CHART_MAX_BUCKETS:
+        return jsonify({"error": "intervallo non valido"}), 400
+    payload = chart_series(user, start_date, end_date, granularity, dimension)
+    payload.update({"start": start_date.isoformat(), "end": (end_date - timedelta(days=1)).isoformat(),
+                    "granularity": granularity, "dimension": dimension})
+    response = jsonify(payload)
+    # ETag sul contenuto: se i dati non sono cambiati il browser riceve un 304 senza corpo
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.max_age = CHART_MAX_AGE_SECONDS
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+# Previsione del saldo giornaliero: pagamenti ricorrenti e scadenze dei prestiti sono
+# flussi certi, mentre entrate e spese libere seguono l'andamento degli ultimi mesi.
+# Tutti i calcoli sono vettoriali sull'asse dei giorni (indice 0 = oggi).
+FORECAST_HISTORY_DAYS = 180
+FORECAST_MAX_MONTHS = 24
+FORECAST_MAX_SIMULATIONS = 10000
+# Celle scenari x giorni della simulazione: limita la memoria per richiesta (~8 MB per matrice)
+FORECAST_MAX_CELLS = 1000000
+RECURRENCE_DAYS = {'Giornaliero': 1, 'Settimanale': 7}
+RECURRENCE_MONTHS = {'Mensile': 1, 'Annuale': 12}
+# Scarto massimo in giorni tra una spesa dello storico e la scadenza del pagamento ricorrente
+RECURRING_MATCH_DAYS = 3
+
+# Giorni (a partire da oggi) in cui cade un pagamento ricorrente, entro l'orizzonte.
+# Con before_first si contano anche le occorrenze precedenti a first_date (per lo storico).
+def occurrence_offsets(first_date, recurrence, today, horizon, before_first=False):
+    start = np.datetime64(today, 'D')
+    first = np.datetime64(first_date, 'D')
+    if recurrence in RECURRENCE_DAYS:
+        step = RECURRENCE_DAYS[recurrence]
+        offset = int((first - start).astype(int))
+        # Una scadenza passata non aggiornata si riporta alla prossima occorrenza
+        if offset < 0 or before_first:
+            offset %= step
+        return np.arange(offset, horizon, step)
+    if recurrence in RECURRENCE_MONTHS:
+        step = RECURRENCE_MONTHS[recurrence]
+        first_month = np.datetime64(first_date, 'M')
+        lag = int((first_month - np.datetime64(today, 'M')).astype(int))
+        if before_first and lag > 0:
+            first_month -= (lag + step - 1) // step * step
+        last_month = np.datetime64(today + timedelta(days=horizon), 'M')
+        months = first_month + np.arange(0, int((last_month - first_month).astype(int)) + 1, step)
+        # Il giorno di scadenza viene limitato alla lunghezza del mese (es. 31 -> 30 aprile)
+        month_days = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(int)
+        dates = months.astype('datetime64[D]') + np.minimum(first_date.day, month_days) - 1
+        offsets = (dates - start).astype(int)
+    else:
+        offsets = np.array([int((first - start).astype(int))])
+    return offsets[(offsets >= 0) & (offsets < horizon)]
+
+# Flussi giornalieri degli ultimi FORECAST_HISTORY_DAYS giorni: spese per categoria ed entrate.
+# Le uscite che corrispondono a un pagamento ricorrente (stesso importo ±1%, nome nella
+# descrizione o nella categoria, data vicina a una scadenza) sono già tra i flussi certi
+# della previsione e vengono escluse, per non contarle due volte.
+def daily_history(user, start_date, days, payments=()):
+    base = user.base_currency or 'EUR'
+    spending, incomes = {}, np.zeros(days)
+    recurring = []
+    for payment in payments:
+        names = {normalize_description(name) for name in (payment.name, payment.description) if name and name.strip()}
+        if names:
+            offsets = occurrence_offsets(payment.due_date, payment.recurrence, start_date,
+                                         days + RECURRING_MATCH_DAYS, before_first=True)
+            recurring.append((payment.amount, names, set(offsets.tolist())))
+
+    def is_recurring(day, description, category, amount):
+        text, category = normalize_description(description), normalize_description(category)
+        for payment_amount, names, offsets in recurring:
+            if abs(payment_amount - amount) > payment_amount * 0.01:
+                continue
+            if not any(name == category or re.search(r'(?<!\w)' + re.escape(name) + r'(?!\w)', text) for name in names):
+                continue
+            near = [offset for offset in offsets if abs(offset - day) <= RECURRING_MATCH_DAYS]
+            if near:
+                # Ogni scadenza giustifica una sola uscita
+                offsets.discard(min(near, key=lambda offset: abs(offset - day)))
+                return True
+        return False
+
+    def add_spending(date, description, category, amount, currency):
+        day = (date - start_date).days
+        if is_recurring(day, description, category, amount):
+            return
+        amount = convert_amount(amount, currency or 'EUR', date, base)
+        spending.setdefault(category or 'Non categorizzato', np.zeros(days))[day] += amount
+
+    for date, description, category, amount, currency in db.session.query(Expense.date, Expense.description, Expense.category, Expense.amount, Expense.currency)\
+            .filter(Expense.user_id == user.id, Expense.date >= start_date).all():
+        add_spending(date, description, category, amount, currency)
+    for date, amount, currency in db.session.query(Income.date, Income.amount, Income.currency)\
+            .filter(Income.user_id == user.id, Income.date >= start_date).all():
+        incomes[(date - start_date).days] += convert_amount(amount, currency or 'EUR', date, base)
+    rows = db.session.query(Transaction.date, Transaction.direction, Transaction.description, Transaction.category, Transaction.amount, Transaction.currency)\
+                .join(Card).outerjoin(Reconciliation, Reconciliation.transaction_id == Transaction.id)\
+                .filter(Card.user_id == user.id, Transaction.category.isnot(None), Reconciliation.id.is_(None),
+                        Transaction.date >= start_date).all()
+    for date, direction, description, category, amount, currency in rows:
+        if direction == 'out':
+            add_spending(date, description, category, abs(amount), currency)
+        else:
+            incomes[(date - start_date).days] += convert_amount(abs(amount), currency or 'EUR', date, base)
+    return spending, incomes
+
+def forecast_balance(user, months, simulations=0, seed=None):
+    today = datetime.now().date()
+    end_months = today.year * 12 + today.month - 1 + months
+    end_date = datetime(end_months // 12, end_months % 12 + 1, min(today.day, 28)).date()
+    horizon = (end_date - today).days + 1
+    total_incomes, total_expenses = balance_totals(user)
+    start_balance = round(total_incomes - total_expenses, 2)
+
+    # Flussi certi: pagamenti ricorrenti (uscite) e prestiti (restituzione o rientro alla scadenza)
+    recurring_flows = np.zeros(horizon)
+    events = []
+    payments = RecurringPayment.query.filter_by(user_id=user.id).all()
+    for payment in payments:
+        offsets = occurrence_offsets(payment.due_date, payment.recurrence, today, horizon)
+        np.add.at(recurring_flows, offsets, -payment.amount)
+        events.extend((int(offset), payment.name, -payment.amount) for offset in offsets[:3])
+    loan_flows = np.zeros(horizon)
+    for loan in Loan.query.filter(Loan.user_id == user.id, Loan.due_date >= today, Loan.due_date <= end_date).all():
+        amount = loan.amount if loan.type == 'lent' else -loan.amount
+        loan_flows[(loan.due_date - today).days] += amount
+        events.append(((loan.due_date - today).days, loan.name, amount))
+    scheduled = recurring_flows + loan_flows
+
+    # Tassi storici di entrate e spese libere
+    history_start = today - timedelta(days=FORECAST_HISTORY_DAYS)
+    spending, incomes = daily_history(user, history_start, FORECAST_HISTORY_DAYS + 1, payments)
+    spending_total = sum(spending.values()) if spending else np.zeros(FORECAST_HISTORY_DAYS + 1)
+    history_net = incomes - spending_total
+
+    balance = start_balance + np.cumsum(scheduled + history_net.mean())
+    dates = [(today + timedelta(days=i)).isoformat() for i in range(horizon)]
+    result = {
+        "currency": user.base_currency or 'EUR',
+        "start_balance": start_balance,
+        "dates": dates,
+        "balance": np.round(balance, 2).tolist(),
+        "end_balance": round(float(balance[-1]), 2),
+        "monthly_income": round(float(incomes.mean() * 30), 2),
+        "monthly_spending": {category: round(float(values.mean() * 30), 2)
+                             for category, values in sorted(spending.items())},
+        "events": [{"date": dates[offset], "name": name, "amount": round(amount, 2)} for offset, name, amount in sorted(events)],
+        "simulations": simulations,
+    }
+    if simulations:
+        # Monte Carlo: ogni scenario ricampiona giorni reali dello storico (bootstrap) e vi
+        # somma i flussi certi; una sola matrice scenari x giorni, senza cicli Python
+        rng = np.random.default_rng(seed)
+        paths = start_balance + np.cumsum(history_net[rng.integers(0, history_net.size, size=(simulations, horizon), dtype=np.int32)] + scheduled, axis=1)
+        low, median, high = np.percentile(paths, [10, 50, 90], axis=0)
+        result.update({
+            "p10": np.round(low, 2).tolist(),
+            "p50": np.round(median, 2).tolist(),
+            "p90": np.round(high, 2).tolist(),
+            "probability_negative": round(float((paths.min(axis=1) < 0).mean()), 4),
+        })
+    return result
+
+def forecast_arguments(args, default_simulations=0):
+    months = min(max(args.get('months', 3, type=int), 1), FORECAST_MAX_MONTHS)
+    simulations = min(max(args.get('simulations', default_simulations, type=int), 0), FORECAST_MAX_SIMULATIONS)
+    # Con orizzonti lunghi si riduce il numero di scenari (31 giorni per mese al massimo)
+    simulations = min(simulations, FORECAST_MAX_CELLS // (months * 31 + 1))
+    return months, simulations, args.get('seed', type=int)
+
+@app.route('/forecast')
+@login_required
+def forecast():
+    user = User.query.get(session['user_id'])
+    months, simulations, seed = forecast_arguments(request.args, default_simulations=2000)
+    data = forecast_balance(user, months, simulations, seed)
+    return render_template('forecast.html', forecast=data, months=months)
+
+@app.route('/api/forecast')
+@login_required
+def api_forecast():
+    user = User.query.get(session['user_id'])
+    months, simulations, seed = forecast_arguments(request.args)
+    return jsonify(forecast_balance(user, months, simulations, seed))
+
+# Stato dei budget visibili all'utente nel mese, con due query: budget e contatori
+def budget_status(user, month):
+    budgets_list = Budget.query.filter(visible_budgets(user)).order_by(Budget.category).all()
+    # Un'unica lettura dei contatori del mese per l'utente e i membri della famiglia
+    counters = db.session.query(SpendCounter.user_id, SpendCounter.category, SpendCounter.total)\
+                    .join(User, User.id == SpendCounter.user_id)\
+                    .filter(SpendCounter.month == month)
+    if user.family_id:
+        counters = counters.filter((SpendCounter.user_id == user.id) | (User.family_id == user.family_id))
+    else:
+        counters = counters.filter(SpendCounter.user_id == user.id)
+    personal, family_totals = {}, {}
+    for uid, category, total in counters.all():
+        if uid == user.id:
+            personal[category] = personal.get(category, 0) + total
+        family_totals[category] = family_totals.get(category, 0) + total
+    data = []
+    for budget in budgets_list:
+        spent = family_totals.get(budget.category, 0) if budget.family_id else personal.get(budget.category, 0)
+        data.append({
+            "budget": budget,
+            "spent": round(spent, 2),
+            "percent": min(100, int(spent / budget.amount * 100)) if budget.amount else 100
+        })
+    return data
+
+@app.route('/budgets', methods=['GET', 'POST'])
+@login_required
+def budgets():
+    user = User.query.get(session['user_id'])
+    if request.method == 'POST':
+        shared = request.form.get('scope') == 'family' and user.family_id
+        new_budget = Budget(
+            user_id=user.id,
+            family_id=user.family_id if shared else None,
+            category=request.form['category'],
+            amount=float(request.form['amount'])
+        )
+        db.session.add(new_budget)
+        db.session.commit()
+        flash("Budget registrato!", "success")
+        return redirect(url_for('budgets'))
+    month = month_start(datetime.now().date())
+    return render_template('budgets.html', budgets=budget_status(user, month), month=month)
+
+@app.route('/delete_budget/<int:budget_id>', methods=['POST'])
+@login_required
+def delete_budget(budget_id):
+    budget = Budget.query.get_or_404(budget_id)
+    if budget.user_id != session['user_id']:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('budgets'))
+    db.session.delete(budget)
+    db.session.commit()
+    flash("Budget eliminato", "success")
+    return redirect(url_for('budgets'))
+
 @app.route('/loans', methods=['GET', 'POST'])
 @login_required
 def loans():
@@ -282,13 +1976,23 @@ def edit_expense(expense_id):
         flash("Operazione non autorizzata", "danger")
         return redirect(url_for('expenses'))
     if request.method == 'POST':
+        currency = request.form.get('currency') or expense.currency or 'EUR'
+        if currency not in CURRENCIES:
+            flash("Valuta non supportata", "danger")
+            return redirect(url_for('edit_expense', expense_id=expense.id))
+        record_spend(expense.user_id, expense.category, expense.date, -expense.amount, expense.currency)
         date_str = request.form.get('date')
         if date_str:
             expense.date = datetime.strptime(date_str, '%Y-%m-%d').date()
         expense.amount = float(request.form.get('amount'))
         expense.category = request.form.get('category')
         expense.description = request.form.get('description')
+        expense.currency = currency
+        alerts = record_spend(expense.user_id, expense.category, expense.date, expense.amount, expense.currency)
         db.session.commit()
+        flash_budget_alerts(alerts)
+        # Le associazioni apprese dipendono dalle categorie scelte manualmente
+        invalidate_categorizer(expense.user_id)
         flash("Spesa aggiornata", "success")
         return redirect(url_for('expenses'))
     return render_template('edit_expense.html', expense=expense)
@@ -300,6 +2004,10 @@ def delete_expense(expense_id):
     if expense.user_id != session['user_id']:
         flash("Operazione non autorizzata", "danger")
         return redirect(url_for('expenses'))
+    record_spend(expense.user_id, expense.category, expense.date, -expense.amount, expense.currency)
+    # La transazione abbinata torna a contare da sola nei totali
+    if expense.reconciliation:
+        record_transactions_spend(expense.user_id, [expense.reconciliation.transaction])
     db.session.delete(expense)
     db.session.commit()
     flash("Spesa eliminata", "success")
@@ -336,6 +2044,321 @@ def delete_income(income_id):
     flash("Entrata eliminata", "success")
     return redirect(url_for('incomes'))
 
+# Modifiche successive al token del client: ?since=<token>, senza token l'elenco completo.
+# Il client applica prima le eliminazioni e poi le modifiche (un id può essere stato riutilizzato).
+@app.route('/api/changes')
+@login_required
+def api_changes():
+    user = User.query.get(session['user_id'])
+    since = request.args.get('since', 0, type=int)
+    # Un token più avanti della sequenza (es. database ripristinato) o precedente alle lapidi
+    # eliminate da prune-tombstones richiede una copia completa
+    reset = since < 0 or since > user.change_seq or 0 < since < user.tombstones_pruned_seq
+    if reset:
+        since = 0
+    token = user.change_seq
+    changes, deleted = {}, {}
+    for kind, model in SYNC_MODELS.items():
+        if model is Transaction:
+            query = Transaction.query.join(Card).filter(Card.user_id == user.id)
+        else:
+            query = model.query.filter(model.user_id == user.id)
+        if since:
+            query = query.filter(model.change_seq > since)
+        changes[kind] = [sync_row(obj) for obj in query.order_by(model.change_seq, model.id).all()]
+        deleted[kind] = []
+    if since:
+        for kind, row_id in db.session.query(Tombstone.kind, Tombstone.row_id)\
+                .filter(Tombstone.user_id == user.id, Tombstone.change_seq > since)\
+                .order_by(Tombstone.change_seq).all():
+            deleted[kind].append(row_id)
+    return jsonify({"token": str(token), "reset": reset, "changes": changes, "deleted": deleted})
+
+# Azioni in blocco sulle righe selezionate negli elenchi
+BULK_MODELS = {'expenses': Expense, 'incomes': Income, 'transactions': Transaction}
+
+@app.route('/bulk/<kind>', methods=['POST'])
+@login_required
+def bulk_action(kind):
+    model = BULK_MODELS.get(kind)
+    if model is None:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('index'))
+    ids = request.form.getlist('selected', type=int)
+    action = request.form.get('action')
+    category = request.form.get('category') or None
+    days = request.form.get('days', 0, type=int)
+    if not ids:
+        flash("Nessuna riga selezionata", "warning")
+        return redirect(request.referrer or url_for(kind))
+    if action not in ('category', 'shift', 'delete') or (action == 'category' and not category) \
+            or (action == 'shift' and (not days or abs(days) > BULK_MAX_SHIFT_DAYS)):
+        flash("Azione non valida", "danger")
+        return redirect(request.referrer or url_for(kind))
+    count, alerts = bulk_update(model, session['user_id'], ids, action, category, days)
+    db.session.commit()
+    if model is Expense and action == 'category':
+        # Le associazioni apprese dipendono dalle categorie scelte manualmente
+        invalidate_categorizer(session['user_id'])
+    messages = {'category': "aggiornate", 'shift': "spostate", 'delete': "eliminate"}
+    flash(f"{count} righe {messages[action]}", "success")
+    flash_budget_alerts(alerts)
+    return redirect(request.referrer or url_for(kind))
+
+# Ricevute: il caricamento viene copiato a blocchi su disco calcolando l'hash (il file non è
+# mai tutto in memoria) e salvato come RECEIPT_FOLDER/ab/<sha256>, quindi i duplicati
+# occupano un solo file. Le immagini vengono poi elaborate in un pool di processi, fuori dalla
+# richiesta: la copia senza metadati EXIF viene salvata con il proprio hash ('file_sha256') e
+# l'originale eliminato. Finché l'elaborazione non è terminata la ricevuta non viene servita.
+RECEIPT_SIGNATURES = {b'\xff\xd8\xff': 'image/jpeg', b'\x89PNG\r\n\x1a\n': 'image/png', b'%PDF-': 'application/pdf'}
+RECEIPT_CHUNK_SIZE = 64 * 1024
+RECEIPT_THUMB_SIZE = (320, 320)
+RECEIPT_MAX_AGE_SECONDS = 365 * 24 * 3600
+# I file più recenti possono appartenere a un caricamento o a un'elaborazione in corso
+RECEIPT_CLEAN_MIN_AGE_SECONDS = 3600
+RECEIPT_WORKERS = int(os.environ.get('RECEIPT_WORKERS', 2))
+RECEIPT_MODELS = {'expense': Expense, 'transaction': Transaction}
+
+def receipt_path(sha256):
+    return os.path.join(app.config['RECEIPT_FOLDER'], sha256[:2], sha256)
+
+def receipt_thumb_path(sha256):
+    return os.path.join(app.config['RECEIPT_FOLDER'], 'thumbs', sha256[:2], sha256 + '.jpg')
+
+def receipt_temp_file():
+    temp_folder = os.path.join(app.config['RECEIPT_FOLDER'], 'tmp')
+    os.makedirs(temp_folder, exist_ok=True)
+    return tempfile.mkstemp(dir=temp_folder)
+
+# Sposta un file temporaneo al suo indirizzo; se lo stesso contenuto è già presente lo scarta
+def move_to_content_address(temp_path, path):
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+def store_receipt(stream):
+    fd, temp_path = receipt_temp_file()
+    digest, size, content_type = hashlib.sha256(), 0, None
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(RECEIPT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if content_type is None:
+                    content_type = next((kind for signature, kind in RECEIPT_SIGNATURES.items() if chunk.startswith(signature)), None)
+                    if content_type is None:
+                        return None
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+        if content_type is None:
+            return None
+        sha256 = digest.hexdigest()
+        move_to_content_address(temp_path, receipt_path(sha256))
+        return sha256, content_type, size
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# Eseguita in un processo separato, senza accesso al database: restituisce l'hash della copia
+# senza metadati. File temporanei con nome univoco, quindi due elaborazioni dello stesso
+# originale non possono corrompersi a vicenda.
+def process_receipt_file(sha256):
+    from PIL import Image, ImageOps
+
+    path = receipt_path(sha256)
+    with Image.open(path) as original:
+        image_format = original.format
+        # Applica l'orientamento indicato dall'EXIF prima di eliminarlo
+        image = ImageOps.exif_transpose(original)
+        image.load()
+    # Salvare di nuovo solo i pixel elimina EXIF (posizione GPS, dispositivo) e gli altri metadati
+    image.info = {}
+    fd, temp_path = receipt_temp_file()
+    with os.fdopen(fd, 'wb') as out:
+        image.save(out, format=image_format, quality=90)
+    with open(temp_path, 'rb') as stripped:
+        file_sha256 = hashlib.sha256(stripped.read()).hexdigest()
+    move_to_content_address(temp_path, receipt_path(file_sha256))
+    thumb = image.convert('RGB')
+    thumb.thumbnail(RECEIPT_THUMB_SIZE)
+    fd, temp_path = receipt_temp_file()
+    with os.fdopen(fd, 'wb') as out:
+        thumb.save(out, format='JPEG', quality=80)
+    move_to_content_address(temp_path, receipt_thumb_path(file_sha256))
+    return file_sha256
+
+_receipt_pool = None
+
+def receipt_pool():
+    global _receipt_pool
+    if _receipt_pool is None:
+        _receipt_pool = ProcessPoolExecutor(max_workers=RECEIPT_WORKERS)
+    return _receipt_pool
+
+def finish_receipt_processing(sha256, file_sha256):
+    Receipt.query.filter_by(sha256=sha256, status='pending')\
+        .update({Receipt.status: 'ready' if file_sha256 else 'error', Receipt.file_sha256: file_sha256}, synchronize_session=False)
+    db.session.commit()
+    # L'originale contiene ancora i metadati: non serve più (né in caso di errore)
+    if file_sha256 != sha256:
+        remove_unused_receipt_files(sha256)
+
+def schedule_receipt_processing(sha256):
+    future = receipt_pool().submit(process_receipt_file, sha256)
+    future.add_done_callback(lambda f: run_in_background(finish_receipt_processing, sha256, None if f.exception() else f.result()))
+
+# Rimuove il file e la miniatura con questo hash se nessuna ricevuta li usa più
+def remove_unused_receipt_files(sha256):
+    in_use = Receipt.query.filter(db.or_(Receipt.file_sha256 == sha256,
+                                         db.and_(Receipt.sha256 == sha256, Receipt.status == 'pending'))).first()
+    if in_use:
+        return
+    for path in (receipt_path(sha256), receipt_thumb_path(sha256)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def send_receipt_file(path, content_type, sha256):
+    if app.config['RECEIPT_ACCEL_PREFIX']:
+        # Il worker risponde solo con gli header: il file viene inviato dal proxy
+        response = app.response_class(mimetype=content_type)
+        response.headers['X-Accel-Redirect'] = app.config['RECEIPT_ACCEL_PREFIX'] + os.path.relpath(path, app.config['RECEIPT_FOLDER'])
+        response.set_etag(sha256)
+    else:
+        response = send_file(path, mimetype=content_type, etag=sha256)
+    # Il contenuto a un dato indirizzo non cambia mai: il browser può conservarlo a lungo
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = RECEIPT_MAX_AGE_SECONDS
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+def owned_receipt(receipt_id):
+    receipt = Receipt.query.get_or_404(receipt_id)
+    return receipt if receipt.user_id == session['user_id'] else None
+
+@app.route('/receipts/<kind>/<int:row_id>', methods=['GET', 'POST'])
+@login_required
+def receipts(kind, row_id):
+    model = RECEIPT_MODELS.get(kind)
+    row = owned_rows(model, session['user_id'], [row_id]).first() if model else None
+    if row is None:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('index'))
+    if request.method == 'POST':
+        upload = request.files.get('receipt')
+        stored = store_receipt(upload.stream) if upload else None
+        if stored is None:
+            flash("Formato non supportato: carica un'immagine JPEG o PNG oppure un PDF", "danger")
+            return redirect(url_for('receipts', kind=kind, row_id=row_id))
+        sha256, content_type, size = stored
+        receipt = Receipt(user_id=session['user_id'], sha256=sha256, content_type=content_type, size=size,
+                          original_name=(upload.filename or '')[:200], status='pending')
+        # I PDF non richiedono elaborazione; per un duplicato si riusa la copia già elaborata
+        # oppure si attende l'elaborazione già in corso
+        existing = Receipt.query.filter(Receipt.sha256 == sha256, Receipt.status.in_(['pending', 'ready']))\
+                        .order_by(Receipt.status.desc()).first()
+        if content_type == 'application/pdf':
+            receipt.status, receipt.file_sha256 = 'ready', sha256
+        elif existing and existing.status == 'ready':
+            receipt.status, receipt.file_sha256 = 'ready', existing.file_sha256
+        setattr(receipt, kind, row)
+        db.session.add(receipt)
+        db.session.commit()
+        if receipt.status == 'ready' and receipt.file_sha256 != sha256:
+            remove_unused_receipt_files(sha256)
+        elif receipt.status == 'pending' and not existing:
+            schedule_receipt_processing(sha256)
+        flash("Ricevuta caricata", "success")
+        return redirect(url_for('receipts', kind=kind, row_id=row_id))
+    return render_template('receipts.html', kind=kind, row=row, receipts=row.receipts)
+
+@app.route('/receipt/<int:receipt_id>')
+@login_required
+def receipt_file(receipt_id):
+    receipt = owned_receipt(receipt_id)
+    if receipt is None or receipt.status != 'ready':
+        return jsonify({"error": "ricevuta non disponibile"}), 404
+    return send_receipt_file(receipt_path(receipt.file_sha256), receipt.content_type, receipt.file_sha256)
+
+@app.route('/receipt/<int:receipt_id>/thumb')
+@login_required
+def receipt_thumb(receipt_id):
+    receipt = owned_receipt(receipt_id)
+    if receipt is None or receipt.status != 'ready' or receipt.content_type == 'application/pdf':
+        return jsonify({"error": "miniatura non disponibile"}), 404
+    return send_receipt_file(receipt_thumb_path(receipt.file_sha256), 'image/jpeg', receipt.file_sha256)
+
+@app.route('/delete_receipt/<int:receipt_id>', methods=['POST'])
+@login_required
+def delete_receipt(receipt_id):
+    receipt = owned_receipt(receipt_id)
+    if receipt is None:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('index'))
+    if receipt.expense_id or receipt.transaction_id:
+        kind, row_id = ('expense', receipt.expense_id) if receipt.expense_id else ('transaction', receipt.transaction_id)
+        target = url_for('receipts', kind=kind, row_id=row_id)
+    else:
+        kind, row_id = ('expense', receipt.archived_expense_id) if receipt.archived_expense_id else ('transaction', receipt.archived_transaction_id)
+        target = url_for('archived_receipts', kind=kind, row_id=row_id)
+    hashes = {receipt.sha256, receipt.file_sha256} - {None}
+    db.session.delete(receipt)
+    db.session.commit()
+    for sha256 in hashes:
+        remove_unused_receipt_files(sha256)
+    flash("Ricevuta eliminata", "success")
+    return redirect(target)
+
+# Ricevute di una spesa o transazione archiviata: la riga viene letta dai segmenti dell'utente
+def find_archived_row(user_id, kind, row_id):
+    folder = os.path.join(app.config['ARCHIVE_FOLDER'], str(user_id))
+    if not os.path.isdir(folder):
+        return None
+    for name in sorted(os.listdir(folder)):
+        if name.startswith(kind + '-') and name.endswith('.csv.gz'):
+            for row in read_archive_segment(os.path.join(folder, name)):
+                if row.id == row_id:
+                    return row
+    return None
+
+@app.route('/receipts/archived/<kind>/<int:row_id>')
+@login_required
+def archived_receipts(kind, row_id):
+    row = find_archived_row(session['user_id'], kind, row_id) if kind in RECEIPT_MODELS else None
+    if row is None:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('index'))
+    column = Receipt.archived_expense_id if kind == 'expense' else Receipt.archived_transaction_id
+    receipts_list = Receipt.query.filter(Receipt.user_id == session['user_id'], column == row_id)\
+                        .order_by(Receipt.id).all()
+    return render_template('receipts.html', kind=kind, row=row, receipts=receipts_list, archived=True)
+
+# Rimuove i file non più usati (es. dopo l'eliminazione di spese, archiviazione o account)
+# e completa le ricevute rimaste in attesa dopo un riavvio
+@app.cli.command('clean-receipts')
+def clean_receipts_command():
+    pending = [sha256 for (sha256,) in db.session.query(Receipt.sha256).filter_by(status='pending').distinct()]
+    for sha256 in pending:
+        try:
+            finish_receipt_processing(sha256, process_receipt_file(sha256))
+        except (OSError, ValueError):
+            finish_receipt_processing(sha256, None)
+    used = {sha256 for (sha256,) in db.session.query(Receipt.file_sha256).filter(Receipt.file_sha256.isnot(None)).distinct()}
+    used.update(pending)
+    cutoff = time.time() - RECEIPT_CLEAN_MIN_AGE_SECONDS
+    removed = 0
+    for folder, _, files in os.walk(app.config['RECEIPT_FOLDER']):
+        for name in files:
+            path = os.path.join(folder, name)
+            if name.split('.')[0] not in used and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    print(f"Rimossi {removed} file, completate {len(pending)} ricevute in attesa.")
+
 @app.route('/edit_loan/<int:loan_id>', methods=['GET', 'POST'])
 @login_required
 def edit_loan(loan_id):
@@ -400,13 +2423,101 @@ def delete_recurring(recurring_id):
     flash("Pagamento ricorrente eliminato", "success")
     return redirect(url_for('recurring'))
 
+# Hash delle password limitati per processo: al massimo PASSWORD_HASH_SLOTS hash occupano la CPU
+# nello stesso momento (con worker a thread; con un worker sincrono ce n'è comunque uno solo).
+# Chi non ottiene un posto entro PASSWORD_HASH_WAIT_SECONDS riceve un errore 503 invece di
+# restare in coda e tenere occupato il worker.
+PASSWORD_HASH_SLOTS = int(os.environ.get('PASSWORD_HASH_SLOTS', 2))
+PASSWORD_HASH_WAIT_SECONDS = float(os.environ.get('PASSWORD_HASH_WAIT_SECONDS', 2))
+password_slots = threading.BoundedSemaphore(PASSWORD_HASH_SLOTS)
+
+class PasswordHashBusy(Exception):
+    pass
+
+def run_password_job(func, *args):
+    if not password_slots.acquire(timeout=PASSWORD_HASH_WAIT_SECONDS):
+        raise PasswordHashBusy()
+    try:
+        return func(*args)
+    finally:
+        password_slots.release()
+
+def hash_password(password):
+    return run_password_job(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(pwhash, password):
+    return run_password_job(check_password_hash, pwhash, password)
+
+# Gli hash creati con un metodo diverso da quello configurato vengono aggiornati al login
+def password_needs_rehash(pwhash):
+    return not pwhash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$')
+
+# Limitazione dei tentativi con un "token bucket" in memoria (per processo): ogni chiave ha
+# 'capacity' gettoni che si ricaricano di uno ogni 'refill_seconds' e ogni tentativo ne consuma
+# uno. Le chiavi meno recenti vengono scartate oltre 'max_keys', per limitare la memoria.
+class TokenBucket:
+    def __init__(self, capacity, refill_seconds, max_keys=10000):
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Restituisce 0 se il tentativo è consentito, altrimenti i secondi da attendere
+    def consume(self, key):
+        with self.lock:
+            now = time.monotonic()
+            tokens, last = self.buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) / self.refill_seconds)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) * self.refill_seconds
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def reset(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+
+# L'indirizzo del client è quello ricavato da ProxyFix (vedi TRUSTED_PROXIES)
+ip_buckets = TokenBucket(int(os.environ.get('LOGIN_ATTEMPTS_PER_IP', 20)), float(os.environ.get('LOGIN_REFILL_SECONDS_PER_IP', 3)))
+account_buckets = TokenBucket(int(os.environ.get('LOGIN_ATTEMPTS_PER_ACCOUNT', 5)), float(os.environ.get('LOGIN_REFILL_SECONDS_PER_ACCOUNT', 60)))
+
+# Controllo eseguito prima di qualunque query o hash: restituisce i secondi da attendere
+def password_throttle(username=None):
+    if not app.config['LOGIN_THROTTLE']:
+        return 0
+    wait = ip_buckets.consume(request.remote_addr or '')
+    if username:
+        wait = max(wait, account_buckets.consume(username.lower()))
+    return wait
+
+def throttled_response(template, wait, status=429):
+    if status == 429:
+        flash(f"Troppi tentativi, riprova tra {int(wait) + 1} secondi.", "danger")
+    else:
+        flash("Il server è occupato, riprova tra qualche secondo.", "danger")
+    response = app.make_response((render_template(template), status))
+    response.headers['Retry-After'] = str(int(wait) + 1)
+    return response
+
 @app.route('/change_password', methods=['GET', 'POST'])
 @login_required
 def change_password():
-    user = User.query.get(session['user_id'])
     if request.method == 'POST':
+        user = get_current_user()
+        wait = password_throttle(user.username)
+        if wait:
+            return throttled_response('change_password.html', wait)
         new_password = request.form.get('new_password')
-        user.password = generate_password_hash(new_password)
+        try:
+            user.password = hash_password(new_password)
+        except PasswordHashBusy:
+            return throttled_response('change_password.html', 0, status=503)
         db.session.commit()
         flash("Password aggiornata", "success")
         return redirect(url_for('account'))
@@ -415,6 +2526,9 @@ def change_password():
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
+        wait = password_throttle()
+        if wait:
+            return throttled_response('register.html', wait)
         username = request.form['username']
         email = request.form['email']
         password = request.form['password']
@@ -424,8 +2538,11 @@ def register():
         if existing_user:
             flash("Username o Email già esistente.", "danger")
             return redirect(url_for('register'))
-        hashed_password = generate_password_hash(password)
-        new_user = User(username=username, email=email, password=hashed_password, family=family, avatar=avatar)
+        try:
+            hashed_password = hash_password(password)
+        except PasswordHashBusy:
+            return throttled_response('register.html', 0, status=503)
+        new_user = User(username=username, email=email, password=hashed_password, family=get_or_create_family(family), avatar=avatar)
         db.session.add(new_user)
         db.session.commit()
         flash("Registrazione avvenuta con successo! Ora puoi fare il login.", "success")
@@ -437,10 +2554,21 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = User.query.filter_by(username=username).first()
-        if not user or not check_password_hash(user.password, password):
+        wait = password_throttle(username)
+        if wait:
+            return throttled_response('login.html', wait)
+        user = User.query.filter_by(username=username, deleted_at=None).first()
+        try:
+            valid = user is not None and verify_password(user.password, password)
+            if valid and password_needs_rehash(user.password):
+                user.password = hash_password(password)
+                db.session.commit()
+        except PasswordHashBusy:
+            return throttled_response('login.html', 0, status=503)
+        if not valid:
             flash("Credenziali non valide.", "danger")
             return redirect(url_for('login'))
+        account_buckets.reset(username.lower())
         session['user_id'] = user.id
         flash("Login effettuato con successo.", "success")
         return redirect(url_for('index'))
@@ -456,18 +2584,25 @@ def logout():
 @app.route('/family')
 @login_required
 def family():
-    # Tutti gli utenti registrati appartengono alla famiglia "Ciconte"
-    family_members = User.query.filter_by(family="Ciconte").all()
+    current_user = User.query.get(session['user_id'])
+    if not current_user.family_id:
+        return render_template('family.html', family_data=[])
+    base = current_user.base_currency or 'EUR'
+    today = datetime.now().date()
+    # Un numero fisso di query, indipendente dal numero di membri
+    members = family_members(current_user.family_id)
+    totals = family_expense_totals(current_user.family_id, base)
+    archived = family_archived_totals(current_user.family_id)
+    recent, largest = family_expense_highlights(current_user.family_id)
     data = []
-    for member in family_members:
-         total_expenses = sum(exp.amount for exp in Expense.query.filter_by(user_id=member.id).all())
-         recent_expense = Expense.query.filter_by(user_id=member.id).order_by(Expense.date.desc()).first()
-         largest_expense = Expense.query.filter_by(user_id=member.id).order_by(Expense.amount.desc()).first()
+    for member in members:
+         # I totali archiviati sono nella valuta base del membro: si convertono al cambio corrente
+         archived_total = convert_amount(archived.get(member.id, 0), member.base_currency, today, base)
          data.append({
               "member": member,
-              "total_expenses": total_expenses,
-              "recent_expense": recent_expense,
-              "largest_expense": largest_expense
+              "total_expenses": round(totals.get(member.id, 0) + archived_total, 2),
+              "recent_expense": recent.get(member.id),
+              "largest_expense": largest.get(member.id)
          })
     return render_template('family.html', family_data=data)
 
@@ -475,11 +2610,22 @@ def family():
 @login_required
 def family_detail(member_id):
     member = User.query.get_or_404(member_id)
+    current_user = User.query.get(session['user_id'])
+    if member.id != current_user.id and (not member.family_id or member.family_id != current_user.family_id):
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('family'))
+    # Senza data di inizio si mostrano solo i dati non archiviati
+    start_date = request.args.get('start_date')
+    start_date = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
     expenses_list = Expense.query.filter_by(user_id=member.id).order_by(Expense.date.desc()).all()
+    if start_date and member.archived_before and start_date < member.archived_before:
+        expenses_list = [exp for exp in expenses_list if exp.date >= start_date]
+        archived = [SimpleNamespace(archived=True, **vars(exp)) for exp in load_archived(member.id, 'expense', start_date, member.archived_before)]
+        expenses_list = sorted(expenses_list + archived, key=lambda exp: exp.date, reverse=True)
     incomes_list = Income.query.filter_by(user_id=member.id).order_by(Income.date.desc()).all()
     loans_list = Loan.query.filter_by(user_id=member.id).order_by(Loan.due_date.desc()).all()
     recurring_list = RecurringPayment.query.filter_by(user_id=member.id).order_by(RecurringPayment.due_date.desc()).all()
-    return render_template('family_detail.html', member=member, expenses=expenses_list, incomes=incomes_list, loans=loans_list, recurring=recurring_list)
+    return render_template('family_detail.html', member=member, expenses=expenses_list, incomes=incomes_list, loans=loans_list, recurring=recurring_list, start_date=start_date)
 
 @app.route('/account')
 @login_required
@@ -503,6 +2649,26 @@ def update_notifications():
     flash("Preferenze notifiche aggiornate.", "success")
     return redirect(url_for('account'))
 
+@app.route('/update_currency', methods=['POST'])
+@login_required
+def update_currency():
+    user = User.query.get(session['user_id'])
+    new_currency = request.form.get('base_currency')
+    if new_currency in CURRENCIES and new_currency != (user.base_currency or 'EUR'):
+        old_currency = user.base_currency or 'EUR'
+        rollups = ArchiveRollup.query.filter_by(user_id=user.id).all()
+        if not all(convertible(old_currency, rollup.month, new_currency) for rollup in rollups):
+            flash(f"Cambio tra {old_currency} e {new_currency} non disponibile: valuta non aggiornata.", "danger")
+            return redirect(url_for('account'))
+        # I totali archiviati vengono riportati nella nuova valuta al cambio del loro mese
+        for rollup in rollups:
+            rollup.total = convert_amount(rollup.total, old_currency, rollup.month, new_currency)
+        user.base_currency = new_currency
+        db.session.commit()
+        rebuild_spend_counters(user.id)
+    flash("Valuta aggiornata.", "success")
+    return redirect(url_for('account'))
+
 @app.route('/api/reminders')
 @login_required
 def api_reminders():
@@ -548,7 +2714,18 @@ def transactions():
     if selected_card != 'all':
         query = query.filter(Transaction.card_id == int(selected_card))
 
-    transactions_list = query.order_by(Transaction.date.desc()).all()
+    transactions_list = query.options(db.joinedload(Transaction.reconciliation))\
+                             .order_by(Transaction.date.desc()).all()
+
+    # Se il periodo arriva oltre l'orizzonte di archiviazione, si leggono anche i segmenti archiviati
+    user = User.query.get(session['user_id'])
+    if user.archived_before and start_date < user.archived_before:
+        cards_by_id = {card.id: card for card in cards}
+        archived = load_archived(user.id, 'transaction', start_date, min(end_date, user.archived_before))
+        if selected_card != 'all':
+            archived = [t for t in archived if t.card_id == int(selected_card)]
+        archived = [SimpleNamespace(card=cards_by_id.get(t.card_id), reconciliation=None, archived=True, **vars(t)) for t in archived]
+        transactions_list = sorted(transactions_list + archived, key=lambda t: t.date, reverse=True)
 
     # Calcoliamo il totale delle entrate e uscite per il periodo selezionato
     total_in = sum(t.amount for t in transactions_list if t.direction == 'in')
@@ -568,6 +2745,10 @@ def transactions():
 def add_transaction():
     cards = Card.query.filter_by(user_id=session['user_id']).all()
     if request.method == 'POST':
+        currency = request.form.get('currency') or 'EUR'
+        if currency not in CURRENCIES:
+            flash("Valuta non supportata", "danger")
+            return redirect(url_for('add_transaction'))
         date_str = request.form.get('date')
         if date_str:
             date = datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -577,10 +2758,14 @@ def add_transaction():
         direction = request.form.get('direction')  # 'in' o 'out'
         description = request.form.get('description')
         card_id = int(request.form.get('card_id'))
-        new_transaction = Transaction(date=date, amount=amount, direction=direction, description=description, card_id=card_id)
+        category = get_categorizer(session['user_id']).categorize(description, amount)
+        new_transaction = Transaction(date=date, amount=amount, direction=direction, description=description, card_id=card_id, category=category, currency=currency)
         db.session.add(new_transaction)
+        alerts = record_transactions_spend(session['user_id'], [new_transaction])
         db.session.commit()
+        reconcile_user(session['user_id'])
         flash("Transazione aggiunta", "success")
+        flash_budget_alerts(alerts)
         return redirect(url_for('transactions'))
     return render_template('add_transaction.html', cards=cards)
 
@@ -599,6 +2784,79 @@ def cards():
     cards = Card.query.filter_by(user_id=session['user_id']).all()
     return render_template('cards.html', cards=cards)
 
+@app.route('/category_rules', methods=['GET', 'POST'])
+@login_required
+def category_rules():
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        pattern = request.form.get('pattern') or None
+        min_amount = request.form.get('min_amount')
+        max_amount = request.form.get('max_amount')
+        if kind == 'regex' and not valid_regex_rule(pattern):
+            flash(f"Espressione regolare non valida o troppo complessa (al massimo {REGEX_RULE_MAX_LENGTH} caratteri, senza quantificatori annidati come (a+)+).", "danger")
+            return redirect(url_for('category_rules'))
+        new_rule = CategoryRule(
+            user_id=session['user_id'],
+            kind=kind,
+            pattern=pattern,
+            min_amount=float(min_amount) if min_amount else None,
+            max_amount=float(max_amount) if max_amount else None,
+            category=request.form['category']
+        )
+        db.session.add(new_rule)
+        db.session.commit()
+        flash("Regola aggiunta", "success")
+        return redirect(url_for('category_rules'))
+    rules = CategoryRule.query.filter_by(user_id=session['user_id']).order_by(CategoryRule.id).all()
+    return render_template('category_rules.html', rules=rules)
+
+@app.route('/delete_category_rule/<int:rule_id>', methods=['POST'])
+@login_required
+def delete_category_rule(rule_id):
+    rule = CategoryRule.query.get_or_404(rule_id)
+    if rule.user_id != session['user_id']:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('category_rules'))
+    db.session.delete(rule)
+    db.session.commit()
+    flash("Regola eliminata", "success")
+    return redirect(url_for('category_rules'))
+
+@app.route('/apply_category_rules', methods=['POST'])
+@login_required
+def apply_category_rules():
+    # Applica le regole alle transazioni già registrate ma ancora senza categoria
+    categorizer = get_categorizer(session['user_id'])
+    uncategorized = Transaction.query.join(Card).filter(
+        Card.user_id == session['user_id'],
+        Transaction.category.is_(None)
+    ).all()
+    categorized = []
+    for t in uncategorized:
+        t.category = categorizer.categorize(t.description, t.amount)
+        if t.category:
+            categorized.append(t)
+    # Le transazioni già abbinate a una spesa sono contate tramite la spesa stessa
+    alerts = record_transactions_spend(session['user_id'], [t for t in categorized if not t.reconciliation])
+    db.session.commit()
+    flash(f"{len(categorized)} transazioni categorizzate", "success")
+    flash_budget_alerts(alerts)
+    return redirect(url_for('category_rules'))
+
+@app.route('/delete_reconciliation/<int:reconciliation_id>', methods=['POST'])
+@login_required
+def delete_reconciliation(reconciliation_id):
+    reconciliation = Reconciliation.query.get_or_404(reconciliation_id)
+    if reconciliation.user_id != session['user_id']:
+        flash("Operazione non autorizzata", "danger")
+        return redirect(url_for('transactions'))
+    alerts = record_transactions_spend(reconciliation.user_id, [reconciliation.transaction])
+    db.session.delete(reconciliation)
+    db.session.commit()
+    flash("Abbinamento rimosso", "success")
+    flash_budget_alerts(alerts)
+    return redirect(url_for('transactions'))
+
 @app.route('/create_link_token', methods=['POST'])
 def create_link_token():
     # Assicurati di avere un ID utente (ad esempio, nella sessione)
@@ -611,6 +2869,9 @@ def create_link_token():
          "language": "it",
          "redirect_uri": "http://localhost:5000/plaid_redirect"  # URI di reindirizzamento
     }
+    # URL pubblico del webhook (es. https://.../plaid/webhook) per ricevere le nuove transazioni
+    if os.environ.get('PLAID_WEBHOOK_URL'):
+         request_payload["webhook"] = os.environ['PLAID_WEBHOOK_URL']
     response = plaid_client.link_token_create(request_payload)
     link_token = response.to_dict()['link_token']
     return jsonify({"link_token": link_token})
@@ -622,15 +2883,18 @@ def exchange_public_token():
     exchange_request = {"public_token": public_token}
     response = plaid_client.item_public_token_exchange(exchange_request)
     access_token = response.to_dict()['access_token']
+    item_id = response.to_dict()['item_id']
 
     # Salva l'access_token associandolo a una carta nel database.
     # Ad esempio, se l'utente ha già una carta (oppure creane una nuova):
     card = Card.query.filter_by(user_id=session['user_id'], card_name="Conto Bancario").first()
     if not card:
-         card = Card(user_id=session['user_id'], card_name="Conto Bancario", plaid_access_token=access_token)
+         card = Card(user_id=session['user_id'], card_name="Conto Bancario", plaid_access_token=access_token, plaid_item_id=item_id)
          db.session.add(card)
     else:
          card.plaid_access_token = access_token
+         card.plaid_item_id = item_id
+         card.plaid_cursor = None
     db.session.commit()
 
     return jsonify({"result": "success", "access_token": access_token})
@@ -652,78 +2916,116 @@ def sync_transactions():
          flash("Nessun conto bancario collegato. Prima collega un conto!", "warning")
          return redirect(url_for('collega_carta'))
 
+    alerts = []
     for card in cards:
          if not card.plaid_access_token:
               continue
+         # Scarica solo le novità rispetto all'ultimo cursore salvato sulla carta
+         _, card_alerts = sync_card(card)
+         alerts.extend(card_alerts)
 
-         # Imposta l'intervallo di sincronizzazione, ad esempio gli ultimi 30 giorni
-         start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-         end_date = datetime.now().strftime('%Y-%m-%d')
-
-         # Per ottenere le transazioni servono gli oggetti TransactionsGetRequest e Options
-         from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
-         from plaid.model.transactions_get_request import TransactionsGetRequest
-
-         options = TransactionsGetRequestOptions(count=100, offset=0)
-         request = TransactionsGetRequest(
-                     access_token=card.plaid_access_token,
-                     start_date=start_date,
-                     end_date=end_date,
-                     options=options
-                  )
-         response = plaid_client.transactions_get(request)
-         transactions_data = response.to_dict().get('transactions', [])
-
-         for t in transactions_data:
-              # Controlla se la transazione è già stata registrata
-              if not Transaction.query.filter_by(external_id=t['transaction_id']).first():
-                  # Imposta una logica per il campo "direction" (questo è un esempio semplice)
-                  direction = 'in' if t['amount'] < 0 else 'out'
-                  new_transaction = Transaction(
-                      external_id=t['transaction_id'],
-                      date=datetime.strptime(t['date'], '%Y-%m-%d').date(),
-                      amount=t['amount'],
-                      direction=direction,
-                      description=t['name'],
-                      card_id=card.id
-                  )
-                  db.session.add(new_transaction)
-         db.session.commit()
-
+    matches = reconcile_user(session['user_id'])
+    if matches:
+        flash(f"{len(matches)} transazioni abbinate a spese già registrate.", "info")
     flash("Transazioni sincronizzate correttamente!", "success")
+    flash_budget_alerts(alerts)
     return redirect(url_for('transactions'))
 
+@app.route('/plaid/webhook', methods=['POST'])
+def plaid_webhook():
+    body = request.get_data()
+    if not verify_plaid_webhook(body, request.headers.get('Plaid-Verification')):
+        return jsonify({"error": "firma non valida"}), 401
+    payload = request.get_json(silent=True) or {}
+    queued = 0
+    if payload.get('webhook_type') == 'TRANSACTIONS' and payload.get('webhook_code') in PLAID_SYNC_WEBHOOK_CODES:
+        for card in Card.query.filter_by(plaid_item_id=payload.get('item_id')).all():
+            if enqueue_card_sync(card.id):
+                queued += 1
+    return jsonify({"result": "ok", "queued": queued})
+
+# Recupera l'item_id di tutte le carte collegate che ne sono prive
+@app.cli.command('backfill-plaid-items')
+def backfill_plaid_items_command():
+    cards = Card.query.filter(Card.plaid_access_token.isnot(None), Card.plaid_item_id.is_(None)).all()
+    for card in cards:
+        try:
+            ensure_plaid_item_id(card)
+            db.session.commit()
+        except plaid.ApiException as e:
+            db.session.rollback()
+            print(f"Carta {card.id}: {e.status} {e.reason}")
+    print(f"Aggiornate {sum(1 for card in cards if card.plaid_item_id)} carte su {len(cards)}.")
+
+# Simulatore locale: firma gli eventi con una chiave generata al momento e li invia
+# all'endpoint, per provare verifica e coalescenza senza passare da Plaid
+@app.cli.command('simulate-plaid-webhook')
+@click.argument('item_id')
+@click.option('--code', default='SYNC_UPDATES_AVAILABLE', help="webhook_code da inviare")
+@click.option('--burst', default=1, help="Numero di eventi inviati in sequenza")
+@click.option('--tamper', is_flag=True, help="Altera il corpo dopo la firma (deve essere rifiutato)")
+def simulate_plaid_webhook_command(item_id, code, burst, tamper):
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    key_id = 'simulatore-locale'
+    _webhook_keys[key_id] = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key()))
+    client = app.test_client()
+    for _ in range(burst):
+        body = json.dumps({"webhook_type": "TRANSACTIONS", "webhook_code": code, "item_id": item_id}).encode()
+        token = jwt.encode({"iat": int(time.time()), "request_body_sha256": hashlib.sha256(body).hexdigest()},
+                           private_key, algorithm='ES256', headers={"kid": key_id})
+        if tamper:
+            body = body.replace(b'}', b', "extra": true}')
+        response = client.post('/plaid/webhook', data=body, content_type='application/json',
+                               headers={"Plaid-Verification": token})
+        print(response.status_code, response.get_json())
+    _webhook_keys.pop(key_id, None)
+
 @app.route('/api/family_expense_notifications')
 @login_required
 def api_family_expense_notifications():
     current_user = User.query.get(session['user_id'])
     if not current_user.notifications_enabled:
          return jsonify([])
+    if not current_user.family_id:
+         return jsonify([])
     notifications = []
-    # Considera tutti i membri della stessa famiglia
-    family_members = User.query.filter_by(family=current_user.family).all()
     threshold = current_user.family_expense_threshold
     # Considera solo le spese registrate negli ultimi 1 giorno per evitare notifiche ripetute
     since = datetime.now() - timedelta(days=1)
-    for member in family_members:
-         high_expenses = Expense.query.filter(
-             Expense.user_id == member.id,
-             Expense.amount >= threshold,
-             Expense.date >= since.date()
-         ).all()
-         for expense in high_expenses:
-              notifications.append(
-                 f"Attenzione: {member.username} ha registrato una spesa di {expense.amount}€ il {expense.date.strftime('%d-%m-%Y')} che supera la soglia di {threshold}€."
-              )
+    # Tutti i membri della stessa famiglia, in un'unica query
+    for username, expense in family_high_expenses(current_user.family_id, threshold, since.date()):
+         notifications.append(
+            f"Attenzione: {username} ha registrato una spesa di {expense.amount}€ il {expense.date.strftime('%d-%m-%Y')} che supera la soglia di {threshold}€."
+         )
     return jsonify(notifications)
 
+@app.route('/api/budget_notifications')
+@login_required
+def api_budget_notifications():
+    current_user = User.query.get(session['user_id'])
+    if not current_user.notifications_enabled:
+         return jsonify([])
+    # Avvisi generati nell'ultimo giorno per i budget personali e per quelli della famiglia
+    since = datetime.utcnow() - timedelta(days=1)
+    alerts = BudgetAlert.query.join(Budget).filter(visible_budgets(current_user), BudgetAlert.created_at >= since)\
+                .order_by(BudgetAlert.created_at).all()
+    return jsonify([alert.message for alert in alerts])
+
 @app.route('/update_password', methods=['POST'])
 @login_required
 def update_password():
-    user = User.query.get(session['user_id'])
+    user = get_current_user()
     new_password = request.form.get('new_password')
-    if new_password:
-        user.password = generate_password_hash(new_password)
+    if new_password and password_throttle(user.username):
+        flash("Troppi tentativi, riprova più tardi.", "danger")
+    elif new_password:
+        try:
+            user.password = hash_password(new_password)
+        except PasswordHashBusy:
+            flash("Il server è occupato, riprova tra qualche secondo.", "danger")
+            return redirect(url_for('account'))
         db.session.commit()
         flash("Password aggiornata con successo.", "success")
     else:
@@ -734,19 +3036,169 @@ def update_password():
 @login_required
 def delete_account():
     user = User.query.get(session['user_id'])
-    db.session.delete(user)
+    # Username ed email vengono liberati subito; i dati sono rimossi in background
+    user.deleted_at = datetime.utcnow()
+    user.username = f"eliminato-{user.id}"
+    user.email = f"eliminato-{user.id}@invalid"
+    user.family_id = None
     db.session.commit()
+    run_in_background(purge_user, user.id)
     session.pop('user_id', None)
     flash("Account eliminato con successo.", "success")
     return redirect(url_for('index'))
 
+# Utente della richiesta, letto dal database solo la prima volta che serve
+def get_current_user():
+    if 'user_id' not in session:
+        return None
+    if 'current_user' not in g:
+        user = User.query.get(session['user_id'])
+        # Un account eliminato (o già cancellato dal purge) non vale più in nessuna sessione
+        g.current_user = user if user is not None and user.deleted_at is None else None
+    return g.current_user
+
 # Aggiungi un context processor per rendere disponibile current_user in ogni template
 @app.context_processor
 def inject_current_user():
-    if 'user_id' in session:
-         user = User.query.get(session['user_id'])
-         return dict(current_user=user)
-    return dict(current_user=None)
+    return dict(current_user=LocalProxy(get_current_user))
+
+# Valute incontrate durante la richiesta senza un cambio verso la valuta base (vedi convert_amount)
+@app.context_processor
+def inject_unconverted_currencies():
+    return dict(unconverted_currencies=sorted(g.get('unconverted_currencies', ())))
+
+# La barra di navigazione dipende solo dall'utente collegato (avatar) e dal template:
+# viene resa una volta per (utente, versione) e poi riusata come frammento HTML
+NAV_CACHE_SIZE = 1024
+_nav_fragments = OrderedDict()
+_nav_lock = threading.Lock()
+
+def nav_version(user):
+    template_mtime = os.path.getmtime(os.path.join(app.root_path, app.template_folder, 'nav.html'))
+    return f"{int(template_mtime)}:{user.avatar if user else ''}"
+
+@app.template_global()
+def cached_nav():
+    user = get_current_user() if 'user_id' in session else None
+    key = (session.get('user_id'), nav_version(user))
+    if app.config['NAV_FRAGMENT_CACHE']:
+        with _nav_lock:
+            if key in _nav_fragments:
+                _nav_fragments.move_to_end(key)
+                return _nav_fragments[key]
+    fragment = Markup(app.jinja_env.get_template('nav.html').render(session=session, current_user=user))
+    if app.config['NAV_FRAGMENT_CACHE']:
+        with _nav_lock:
+            _nav_fragments[key] = fragment
+            if len(_nav_fragments) > NAV_CACHE_SIZE:
+                _nav_fragments.popitem(last=False)
+    return fragment
+
+# Tempi di compilazione e di risposta delle pagine, senza e con le cache dei template
+@app.cli.command('benchmark-templates')
+@click.argument('username')
+@click.option('--repeat', default=50, help="Richieste per pagina")
+def benchmark_templates_command(username, repeat):
+    user = User.query.filter_by(username=username, deleted_at=None).first()
+    if user is None:
+        print("Utente non trovato.")
+        return
+    templates = app.jinja_env.list_templates(extensions=['html'])
+
+    def compile_all(bytecode_cache):
+        # Ambiente nuovo con cache dei template vuota, come un worker appena avviato
+        env = app.jinja_env.overlay(bytecode_cache=bytecode_cache, cache_size=0)
+        start = time.perf_counter()
+        for name in templates:
+            env.get_template(name)
+        return (time.perf_counter() - start) * 1000
+
+    compile_all(app.jinja_env.bytecode_cache)
+    print(f"Compilazione di {len(templates)} template: {compile_all(None):.1f} ms senza cache, "
+          f"{compile_all(app.jinja_env.bytecode_cache):.1f} ms con la cache del bytecode")
+
+    pages = ['/', '/expenses', '/incomes', '/balance', '/loans', '/recurring', '/transactions', '/cards', '/budgets', '/account']
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = user.id
+    results = {}
+    for enabled in (False, True):
+        app.config['NAV_FRAGMENT_CACHE'] = enabled
+        for page in pages:
+            client.get(page)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                client.get(page)
+            results.setdefault(page, []).append((time.perf_counter() - start) * 1000 / repeat)
+    app.config['NAV_FRAGMENT_CACHE'] = True
+    print(f"{'Pagina':<16}{'senza cache':>14}{'con cache':>14}")
+    for page, (before, after) in results.items():
+        print(f"{page:<16}{before:>11.2f} ms{after:>11.2f} ms")
+
+# Prova di carico: latenza di una pagina normale da sola e durante un'ondata di login errati
+# a ritmo costante da più indirizzi, con e senza la limitazione dei tentativi
+@app.cli.command('benchmark-login')
+@click.argument('username')
+@click.option('--attackers', default=8, help="Thread che inviano login errati, ognuno con il proprio indirizzo IP")
+@click.option('--rate', default=20, help="Tentativi al secondo per thread")
+@click.option('--requests', 'page_requests', default=200, help="Richieste alla pagina misurata")
+def benchmark_login_command(username, attackers, rate, page_requests):
+    user = User.query.filter_by(username=username, deleted_at=None).first()
+    if user is None:
+        print("Utente non trovato.")
+        return
+    user_id = user.id
+    db.session.remove()
+
+    def measure_page():
+        client = app.test_client()
+        with client.session_transaction() as client_session:
+            client_session['user_id'] = user_id
+        client.get('/account')
+        timings = []
+        for _ in range(page_requests):
+            start = time.perf_counter()
+            client.get('/account')
+            timings.append((time.perf_counter() - start) * 1000)
+        return np.percentile(timings, [50, 95])
+
+    def flood(index, statuses, stop):
+        client = app.test_client()
+        attempt = 0
+        while not stop.is_set():
+            # Credential stuffing: alcuni account presi di mira a rotazione, più un utente reale
+            target = username if attempt % 4 == 0 else f"vittima{attempt % 10}"
+            response = client.post('/login', data={'username': target, 'password': 'sbagliata'},
+                                   environ_base={'REMOTE_ADDR': f"10.0.0.{index}"})
+            statuses.append(response.status_code)
+            attempt += 1
+            stop.wait(1 / rate)
+
+    def under_flood():
+        statuses, stop = [], threading.Event()
+        threads = [threading.Thread(target=flood, args=(index, statuses, stop)) for index in range(attackers)]
+        for thread in threads:
+            thread.start()
+        # L'ondata parte prima della misura, in modo da saturare il pool degli hash
+        time.sleep(1)
+        percentiles = measure_page()
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return percentiles, statuses
+
+    throttle = app.config['LOGIN_THROTTLE']
+    p50, p95 = measure_page()
+    print(f"{'Senza carico':<34}p50 {p50:7.2f} ms  p95 {p95:7.2f} ms")
+    for enabled in (False, True):
+        app.config['LOGIN_THROTTLE'] = enabled
+        ip_buckets.buckets.clear()
+        account_buckets.buckets.clear()
+        (p50, p95), statuses = under_flood()
+        counts = ", ".join(f"{status}: {statuses.count(status)}" for status in sorted(set(statuses)))
+        label = "Login in massa " + ("con limitazione" if enabled else "senza limitazione")
+        print(f"{label:<34}p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  ({counts})")
+    app.config['LOGIN_THROTTLE'] = throttle
 
 if __name__ == '__main__':
     with app.app_context():
@@ -97,6 +97,10 @@ def run_migrations_online():
     connectable = get_engine()
 
     with connectable.connect() as connection:
+        # le migrazioni "batch" di SQLite ricreano le tabelle: con i vincoli attivi
+        # il DROP della tabella originale farebbe scattare ON DELETE CASCADE
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
         context.configure(
             connection=connection,
             target_metadata=get_metadata(),
@@ -0,0 +1,80 @@
+"""Tabella famiglie al posto del campo testuale User.family
+
+Revision ID: 0b7e4d2a6f58
+Revises: f4d27a8c9e63
+Create Date: 2026-10-19 16:48:26.135990
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b7e4d2a6f58'
+down_revision = 'f4d27a8c9e63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('family',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('family_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_family_id'), ['family_id'], unique=False)
+        batch_op.create_foreign_key('fk_user_family_id_family', 'family', ['family_id'], ['id'], ondelete='SET NULL')
+
+    with op.batch_alter_table('budget', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('family_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_budget_family_id'), ['family_id'], unique=False)
+        batch_op.create_foreign_key('fk_budget_family_id_family', 'family', ['family_id'], ['id'], ondelete='CASCADE')
+
+    # Converte i nomi di famiglia esistenti in righe della nuova tabella
+    op.execute(
+        'INSERT INTO family (name) '
+        'SELECT DISTINCT family FROM "user" WHERE family IS NOT NULL AND family <> \'\' '
+        'UNION SELECT DISTINCT family FROM budget WHERE family IS NOT NULL AND family <> \'\''
+    )
+    op.execute('UPDATE "user" SET family_id = (SELECT id FROM family WHERE family.name = "user".family)')
+    op.execute('UPDATE budget SET family_id = (SELECT id FROM family WHERE family.name = budget.family)')
+
+    with op.batch_alter_table('budget', schema=None) as batch_op:
+        batch_op.drop_index('ix_budget_family')
+        batch_op.drop_column('family')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('family')
+
+    with op.batch_alter_table('expense', schema=None) as batch_op:
+        batch_op.create_index('ix_expense_user_id_date', ['user_id', 'date'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('expense', schema=None) as batch_op:
+        batch_op.drop_index('ix_expense_user_id_date')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('family', sa.String(length=100), nullable=True))
+
+    with op.batch_alter_table('budget', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('family', sa.String(length=100), nullable=True))
+        batch_op.create_index('ix_budget_family', ['family'], unique=False)
+
+    op.execute('UPDATE "user" SET family = (SELECT name FROM family WHERE family.id = "user".family_id)')
+    op.execute('UPDATE budget SET family = (SELECT name FROM family WHERE family.id = budget.family_id)')
+
+    with op.batch_alter_table('budget', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_budget_family_id_family', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_budget_family_id'))
+        batch_op.drop_column('family_id')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_user_family_id_family', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_user_family_id'))
+        batch_op.drop_column('family_id')
+
+    op.drop_table('family')
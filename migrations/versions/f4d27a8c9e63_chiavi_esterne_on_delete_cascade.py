@@ -0,0 +1,78 @@
+"""Chiavi esterne ON DELETE CASCADE e cancellazione account in background
+
+Revision ID: f4d27a8c9e63
+Revises: e9a3b5c1d047
+Create Date: 2026-10-19 15:31:08.417725
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4d27a8c9e63'
+down_revision = 'e9a3b5c1d047'
+branch_labels = None
+depends_on = None
+
+# Le chiavi esterne create senza nome vengono individuate con questa convenzione (SQLite)
+# oppure con il nome generato da PostgreSQL (<tabella>_<colonna>_fkey)
+naming_convention = {
+    "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
+}
+
+FOREIGN_KEYS = [
+    ('expense', 'user_id', 'user'),
+    ('income', 'user_id', 'user'),
+    ('loan', 'user_id', 'user'),
+    ('recurring_payment', 'user_id', 'user'),
+    ('card', 'user_id', 'user'),
+    ('transaction', 'card_id', 'card'),
+    ('category_rule', 'user_id', 'user'),
+    ('reconciliation', 'user_id', 'user'),
+    ('reconciliation', 'expense_id', 'expense'),
+    ('reconciliation', 'transaction_id', 'transaction'),
+    ('budget', 'user_id', 'user'),
+    ('spend_counter', 'user_id', 'user'),
+    ('budget_alert', 'budget_id', 'budget'),
+    ('archive_rollup', 'user_id', 'user'),
+]
+
+INDEXES = [
+    ('expense', 'user_id'),
+    ('income', 'user_id'),
+    ('loan', 'user_id'),
+    ('recurring_payment', 'user_id'),
+    ('card', 'user_id'),
+    ('transaction', 'card_id'),
+]
+
+
+def _recreate_foreign_keys(ondelete):
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for table, column, referred in FOREIGN_KEYS:
+        name = f"fk_{table}_{column}_{referred}"
+        with op.batch_alter_table(table, schema=None, naming_convention=naming_convention) as batch_op:
+            batch_op.drop_constraint(name if sqlite else f"{table}_{column}_fkey", type_='foreignkey')
+            batch_op.create_foreign_key(name if sqlite else f"{table}_{column}_fkey", referred, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    _recreate_foreign_keys('CASCADE')
+    for table, column in INDEXES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_index(batch_op.f(f'ix_{table}_{column}'), [column], unique=False)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('deleted_at')
+
+    for table, column in INDEXES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(batch_op.f(f'ix_{table}_{column}'))
+
+    _recreate_foreign_keys(None)